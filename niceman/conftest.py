@@ -12,4 +12,5 @@
 # Some commonly used fixtures
 
 from niceman.tests.fixtures import niceman_cfg_path
+from niceman.tests.fixtures import niceman_user_cache_dir
 from niceman.formats.tests.fixtures import demo1_spec, reprozip_spec2
\ No newline at end of file
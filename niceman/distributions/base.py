@@ -18,10 +18,35 @@ from importlib import import_module
 from six import viewvalues
 
 from niceman.resource.session import get_local_session
+from niceman.support.exceptions import CommandError
+from niceman.utils import to_unicode
+from niceman.utils import unique
 
 import logging
 lgr = logging.getLogger('niceman.distributions')
 
+# Pick a conservative max command-line
+try:
+    _MAX_LEN_CMDLINE = os.sysconf(str("SC_ARG_MAX")) // 2
+except (ValueError, AttributeError):
+    _MAX_LEN_CMDLINE = 2048
+
+
+def get_chunks(args, cmd_len=0):
+    """Split args into chunks which could be passed to a command at once
+
+    Parameters
+    ----------
+    args : list of str
+    cmd_len : int, optional
+      Length of the command (with its options) the args will be added to
+    """
+    # Find out how many args we can pass at once
+    max_len = max([len(a) for a in args])
+    num_args = max((_MAX_LEN_CMDLINE - cmd_len) // (max_len + 1), 1)
+    for pos in range(0, len(args), num_args):
+        yield args[pos:pos + num_args]
+
 
 Factory = attr.Factory
 
@@ -123,6 +148,21 @@ class Distribution(SpecObject):
         """
         return
 
+    def verify_packages(self, session):
+        """Verify that the packages are installed in the environment
+
+        Parameters
+        ----------
+        session : object
+            Session to work in
+
+        Returns
+        -------
+        list
+            Packages which are not installed as specified
+        """
+        raise NotImplementedError
+
 # So this one is no longer "distributions/" module specific
 # TODO: move up! and strip Spec suffix
 @attr.s
@@ -154,11 +194,14 @@ class DistributionTracer(object):
     # Default to being able to handle directories
     HANDLES_DIRS = True
 
-    def __init__(self, session=None):
+    def __init__(self, session=None, jobs=None):
         # will be (re)used to run external commands, and let's hardcode LC_ALL
         # codepage just in case since we might want to comprehend error
         # messages
         self._session = session or get_local_session()
+        # how many independent commands (e.g. queries for chunks of files)
+        # could be run concurrently within the session
+        self._jobs = jobs or 1
         # to ease _init within derived classes which should not be parametrized
         # more anyways
         self._init()
@@ -166,6 +209,50 @@ class DistributionTracer(object):
     def _init(self):
         pass
 
+    def _map(self, func, args):
+        """Return [func(arg) for arg in args], running up to `jobs` at a time
+
+        Results are in the order of args regardless of the order in which
+        they complete, so they could be merged deterministically.  The first
+        exception raised by func is re-raised.
+        """
+        args = list(args)
+        jobs = min(self._jobs, len(args))
+        if jobs <= 1:
+            return [func(arg) for arg in args]
+        # Threads are sufficient since the time goes to waiting for commands
+        # to complete within the session, e.g. for round trips over ssh
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(jobs)
+        try:
+            return pool.map(func, args)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _run_chunked(self, cmd, args):
+        """Run cmd over all args, splitting them into chunks as needed
+
+        Failures (e.g. if some of the args are not known to the command) are
+        tolerated, and output produced for the rest of the args is returned.
+        """
+        def run(subargs):
+            try:
+                out, _ = self._session.execute_command(cmd + subargs)
+            except CommandError as exc:
+                lgr.debug("%s failed for some of the args: %s",
+                          ' '.join(cmd), exc.stderr)
+                out = exc.stdout or ''
+            return to_unicode(out, "utf-8")
+
+        return '\n'.join(
+            self._map(run, get_chunks(args, len(' '.join(cmd)))))
+
+    def _is_local_session(self):
+        """Return True if files of the session could be accessed directly"""
+        from niceman.resource.shell import ShellSession
+        return isinstance(self._session, ShellSession)
+
     @abc.abstractmethod
     def identify_distributions(self, files):
         raise NotImplementedError()
@@ -210,6 +297,12 @@ class DistributionTracer(object):
         # TODO: probably that _get_packagefields should create packagespecs
         # internally and just return them.  But we should make them hashable
         file_to_package_dict = self._get_packagefields_for_files(files)
+        # Let the tracer gather details for all the packages at once, so
+        # _create_package would not need to query them one at a time
+        self._prefetch_packages(
+            unique(filter(None, viewvalues(file_to_package_dict)),
+                   key=lambda pkgfields: tuple(sorted(pkgfields.items())))
+        )
         for f in files:
             # Stores the file
             if f not in file_to_package_dict:
@@ -254,6 +347,16 @@ class DistributionTracer(object):
         """
         raise NotImplementedError
 
+    def _prefetch_packages(self, packagefields):
+        """Given a list of unique packagefields (as returned by
+        _get_packagefields_for_files), gather information needed to create
+        those packages in bulk.
+
+        By default does nothing, so every package is queried separately
+        within _create_package.
+        """
+        pass
+
     @abc.abstractmethod
     def _create_package(self, **package_fields):
         """Creates implementation-specific Package object using fields
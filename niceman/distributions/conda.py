@@ -7,14 +7,18 @@
 #
 # ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 """Orchestrator sub-class to provide management of the localhost environment."""
+import hashlib
 import json
 import os
 import re
+import threading
 from collections import defaultdict
+from glob import glob
 
 import attr
 import yaml
 
+from niceman import cfg
 from niceman.distributions import Distribution
 
 from .base import SpecObject
@@ -22,10 +26,41 @@ from .base import DistributionTracer
 from .base import Package
 from .base import TypedList
 from niceman.dochelpers import exc_str
+from niceman.utils import assure_dir
+from niceman.utils import to_unicode
 
 import logging
 lgr = logging.getLogger('niceman.distributions.conda')
 
+# Separates JSON documents concatenated from conda-meta/*.json
+_RE_WHITESPACE = re.compile(r'\s*')
+
+# Files of metadata directories of packages installed by pip, which provide
+# name and version, and a list of files of the package
+_PIP_METADATA_FILES = {
+    '.dist-info': ('METADATA', 'RECORD'),
+    '.egg-info': ('PKG-INFO', 'installed-files.txt'),
+}
+
+
+def _normalize_pip_name(name):
+    """Normalize name of a pip package as PEP 503 prescribes"""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def _parse_record_path(line):
+    """Return path from a line of RECORD (a CSV of path, hash and size)"""
+    path = line.rsplit(',', 2)[0]
+    if path.startswith('"') and path.endswith('"'):
+        path = path[1:-1].replace('""', '"')
+    return path
+
+
+def _get_conda_meta_filename(details):
+    """Return name of the conda-meta file with the package details"""
+    return '%s-%s-%s.json' % (details.get('name'), details.get('version'),
+                              details.get('build'))
+
 
 @attr.s
 class CondaPackage(Package):
@@ -105,7 +140,8 @@ class CondaTracer(DistributionTracer):
     """
 
     def _init(self):
-        self._paths_cache = {}      # path -> False or CondaDistribution
+        self._paths_cache = {}      # path -> whether it is a conda environment
+        self._memo = {}             # (kind, path) -> details
 
     def _get_packagefields_for_files(self, files):
         raise NotImplementedError("TODO")
@@ -113,28 +149,58 @@ class CondaTracer(DistributionTracer):
     def _create_package(self, *fields):
         raise NotImplementedError("TODO")
 
-    def _get_conda_meta_files(self, conda_path):
+    def _iter_conda_meta(self, conda_path):
+        """Yield parsed content of all conda-meta/*.json in the environment
+
+        Files are read directly for a local session, otherwise they are
+        concatenated by a single command and decoded one after another.
+        """
+        meta_dir = os.path.join(conda_path, 'conda-meta')
+        if self._is_local_session():
+            for meta_file in sorted(glob(os.path.join(meta_dir, '*.json'))):
+                try:
+                    with open(meta_file, 'rb') as f:
+                        yield json.loads(to_unicode(f.read(), "utf-8"))
+                except (IOError, OSError, ValueError) as exc:
+                    lgr.warning("Could not read conda-meta file %s: %s",
+                                meta_file, exc_str(exc))
+            return
         try:
             out, _ = self._session.execute_command(
-                'ls %s/conda-meta/*.json'
-                % conda_path
+                ['find', meta_dir, '-maxdepth', '1', '-name', '*.json',
+                 '-exec', 'cat', '{}', '+']
             )
-            return iter(out.splitlines())
         except Exception as exc:
             lgr.warning("Could not retrieve conda-meta files in path %s: %s",
                         conda_path, exc_str(exc))
+            return
+        out = to_unicode(out, "utf-8")
+        decoder = json.JSONDecoder()
+        records = []
+        pos = _RE_WHITESPACE.match(out).end()
+        while pos < len(out):
+            try:
+                details, pos = decoder.raw_decode(out, pos)
+            except ValueError as exc:
+                lgr.warning("Could not parse conda-meta files in path %s: %s",
+                            conda_path, exc_str(exc))
+                break
+            records.append(details)
+            pos = _RE_WHITESPACE.match(out, pos).end()
+        # find lists files in the order of the filesystem, so sort as the
+        # local files are, by their names (NAME-VERSION-BUILD.json)
+        for details in sorted(records, key=_get_conda_meta_filename):
+            yield details
 
-    def _get_conda_package_details(self, conda_path):
+    def _get_conda_package_details(self, conda_path, files=None):
+        """Return details of conda packages and a map of files to packages
+
+        If `files` (a set of full paths) is specified, only those are mapped.
+        """
         packages = {}
         file_to_package_map = {}
-        for meta_file in self._get_conda_meta_files(conda_path):
+        for details in self._iter_conda_meta(conda_path):
             try:
-                out, err = self._session.execute_command(
-                    'cat %s' % meta_file
-                )
-                details = json.loads(out)
-#                print meta_file
-#                print(json.dumps(details, indent=4))
                 if "name" in details:
                     lgr.debug("Found conda package %s", details["name"])
                     # Packages are recorded in the conda environment as
@@ -147,7 +213,9 @@ class CondaTracer(DistributionTracer):
                     for f in details["files"]:
                         full_path = os.path.normpath(
                             os.path.join(conda_path, f))
-                        file_to_package_map[full_path] = conda_package_name
+                        if files is None or full_path in files:
+                            file_to_package_map[full_path] = \
+                                conda_package_name
             except Exception as exc:
                 lgr.warning("Could not retrieve conda info in path %s: %s",
                             conda_path,
@@ -182,7 +250,116 @@ class CondaTracer(DistributionTracer):
 
         return pip_info
 
-    def _get_conda_pip_package_details(self, env_export, conda_path):
+    def _read_pip_metadata_files(self, conda_path):
+        """Return {path: content} of the metadata files of all packages
+        installed by pip within site-packages of the environment
+
+        Files are read directly for a local session, otherwise all of them
+        are output by a single command with NUL separated paths.
+        """
+        lib_path = os.path.join(conda_path, 'lib')
+        if self._is_local_session():
+            files = {}
+            for ext, filenames in _PIP_METADATA_FILES.items():
+                for filename in filenames:
+                    for path in glob(os.path.join(
+                            lib_path, 'python*', 'site-packages',
+                            '*' + ext, filename)):
+                        try:
+                            with open(path, 'rb') as f:
+                                files[path] = to_unicode(f.read(), "utf-8")
+                        except (IOError, OSError) as exc:
+                            lgr.debug("Could not read %s: %s",
+                                      path, exc_str(exc))
+            return files
+        names = []
+        for filenames in _PIP_METADATA_FILES.values():
+            for filename in filenames:
+                names += ['-o', '-name', filename]
+        try:
+            out, _ = self._session.execute_command(
+                ['find', lib_path, '-mindepth', '4', '-maxdepth', '4',
+                 '-path', '*/site-packages/*', '('] + names[1:] +
+                [')', '-printf', '\\0%p\\0', '-exec', 'cat', '{}', ';']
+            )
+        except Exception as exc:
+            lgr.warning("Could not retrieve pip metadata files in path %s: %s",
+                        conda_path, exc_str(exc))
+            return {}
+        parts = to_unicode(out, "utf-8").split('\0')
+        return dict(zip(parts[1::2], parts[2::2]))
+
+    def _get_pip_packages_index(self, conda_path):
+        """Return {normalized name: details} of the packages installed by pip
+
+        Details are collected from METADATA and RECORD of *.dist-info, and
+        PKG-INFO and installed-files.txt of *.egg-info directories, and
+        contain name, version and (absolute) files of the package.
+        """
+        files = self._read_pip_metadata_files(conda_path)
+        index = {}
+        for metadata_dir in sorted(set(map(os.path.dirname, files))):
+            ext = os.path.splitext(metadata_dir)[1]
+            metadata_name, record_name = _PIP_METADATA_FILES[ext]
+            metadata = files.get(os.path.join(metadata_dir, metadata_name))
+            record = files.get(os.path.join(metadata_dir, record_name))
+            if metadata is None or record is None:
+                continue  # leave it to pip
+            headers = self._parse_pip_metadata(metadata)
+            if not headers.get("Name"):
+                continue
+            if ext == '.dist-info':
+                # paths are relative to site-packages
+                base_path = os.path.dirname(metadata_dir)
+                paths = map(_parse_record_path, record.splitlines())
+            else:
+                # paths are relative to the .egg-info directory
+                base_path = metadata_dir
+                paths = record.splitlines()
+            index[_normalize_pip_name(headers["Name"])] = {
+                "name": headers["Name"],
+                "version": headers.get("Version"),
+                "files": [os.path.normpath(os.path.join(base_path, f))
+                          for f in paths if f.strip()]
+            }
+        return index
+
+    @staticmethod
+    def _parse_pip_metadata(out):
+        """Parse headers of METADATA or PKG-INFO into a dict"""
+        headers = {}
+        for line in out.splitlines():
+            if not line.strip():
+                break  # the rest is the description
+            if line.startswith((" ", "\t")) or ":" not in line:
+                continue  # continuation of a multiline value
+            tag, value = line.split(":", 1)
+            headers.setdefault(tag.strip(), value.strip())
+        return headers
+
+    def _get_pip_show_details(self, conda_path, name):
+        """Return name, version and (absolute) files of the package as
+        reported by pip
+        """
+        out, err = self._session.execute_command(
+            '%s/bin/pip show -f %s'
+            % (conda_path, name)
+        )
+        pip_info = self._parse_pip_show(out)
+        return {
+            "name": pip_info.get("Name"),
+            "version": pip_info.get("Version"),
+            "files": [os.path.normpath(
+                          os.path.join(pip_info.get("Location"), f))
+                      for f in pip_info.get("Files")]
+        }
+
+    def _get_conda_pip_package_details(self, env_export, conda_path,
+                                       files=None):
+        """Return details of pip packages and a map of files to packages
+
+        If `files` (a set of full paths) is specified, only those are mapped.
+        """
         packages = {}
         file_to_package_map = {}
         dependencies = env_export.get("dependencies")
@@ -192,25 +369,26 @@ class CondaTracer(DistributionTracer):
             if isinstance(dep, dict) and "pip" in dep:
                 pip_deps = dep.get("pip")
 
+        pip_index = self._get_pip_packages_index(conda_path) \
+            if pip_deps else {}
         for pip_dep in pip_deps:
             name, origin_location = self.parse_pip_package_entry(pip_dep)
             try:
-                out, err = self._session.execute_command(
-                    '%s/bin/pip show -f %s'
-                    % (conda_path, name)
-                )
-                pip_info = self._parse_pip_show(out)
+                pip_info = pip_index.get(_normalize_pip_name(name))
+                if pip_info is None:
+                    # e.g. installed in development mode, so metadata is
+                    # not within site-packages
+                    pip_info = self._get_pip_show_details(conda_path, name)
                 # Record the details we care about
-                details = {"name": pip_info.get("Name"),
-                           "version": pip_info.get("Version"),
+                details = {"name": pip_info["name"],
+                           "version": pip_info["version"],
                            "installer": "pip",
                            "origin_location": origin_location}
                 packages[pip_dep] = details
                 # Map the package files to the package
-                for f in pip_info.get("Files"):
-                    full_path = os.path.normpath(
-                        os.path.join(pip_info.get("Location"), f))
-                    file_to_package_map[full_path] = pip_dep
+                for full_path in pip_info["files"]:
+                    if files is None or full_path in files:
+                        file_to_package_map[full_path] = pip_dep
             except Exception as exc:
                 lgr.warning("Could not retrieve pip info "
                             "export from path %s: %s", conda_path,
@@ -233,7 +411,115 @@ class CondaTracer(DistributionTracer):
             origin_location = None
         return name, origin_location
 
+    def _get_history_mtime(self, conda_path):
+        """Return mtime of the conda-meta/history of the environment or None
+
+        conda appends to the history upon any change to the environment.
+        """
+        history = os.path.join(conda_path, 'conda-meta', 'history')
+        if self._is_local_session():
+            try:
+                return str(os.path.getmtime(history))
+            except OSError:
+                return None
+        try:
+            out, _ = self._session.execute_command(
+                ['stat', '-c', '%Y', history])
+        except Exception as exc:
+            lgr.debug("Could not stat %s: %s", history, exc_str(exc))
+            return None
+        return to_unicode(out, "utf-8").strip() or None
+
+    def _get_site_packages_mtime(self, conda_path):
+        """Return mtimes of the site-packages of the environment or None
+
+        pip does not record its changes in the conda history, but it adds
+        or removes its metadata directories in site-packages.
+        """
+        lib = os.path.join(conda_path, 'lib')
+        if self._is_local_session():
+            try:
+                return ' '.join(
+                    str(os.path.getmtime(p)) for p in
+                    sorted(glob(os.path.join(lib, '*', 'site-packages'))))
+            except OSError:
+                return None
+        try:
+            out, _ = self._session.execute_command(
+                ['find', lib, '-mindepth', '2', '-maxdepth', '2',
+                 '-name', 'site-packages', '-printf', '%p %T@\\n'])
+        except Exception as exc:
+            lgr.debug("Could not find site-packages under %s: %s",
+                      lib, exc_str(exc))
+            return None
+        return ' '.join(sorted(to_unicode(out, "utf-8").splitlines()))
+
+    def _get_cache_path(self, kind, conda_path, pip_state=False):
+        """Return path to the on-disk cache of `kind` details of the
+        environment, or None if those are not to be cached
+
+        If `pip_state`, the details depend also on the packages pip installed.
+        """
+        if not cfg.getboolean('conda', 'use cache', default=True):
+            return None
+        mtime = self._get_history_mtime(conda_path)
+        if mtime is not None and pip_state:
+            site_packages_mtime = self._get_site_packages_mtime(conda_path)
+            mtime = None if site_packages_mtime is None \
+                else mtime + ' ' + site_packages_mtime
+        if mtime is None:
+            return None
+        key = '%s %s %s' % (kind, conda_path, mtime)
+        return os.path.join(
+            cfg.getpath('conda', 'cache dir',
+                        default=os.path.join(cfg.dirs.user_cache_dir,
+                                             'conda')),
+            hashlib.md5(key.encode('utf-8')).hexdigest() + '.json')
+
+    def _memoize(self, kind, conda_path, get, pip_state=False):
+        """Return get() memoized per environment within the tracer and on disk
+        """
+        key = (kind, conda_path)
+        if key in self._memo:
+            return self._memo[key]
+        cache_path = self._get_cache_path(kind, conda_path, pip_state)
+        value = None
+        if cache_path and os.path.exists(cache_path):
+            try:
+                with open(cache_path) as f:
+                    value = json.load(f)
+                lgr.debug("Using cached %s of %s from %s",
+                          kind, conda_path, cache_path)
+            except (IOError, ValueError) as exc:
+                lgr.warning("Failed to load cache from %s: %s",
+                            cache_path, exc_str(exc))
+        if value is None:
+            value = get()
+            # failures result in empty details which we do not persist
+            if value and cache_path:
+                try:
+                    assure_dir(os.path.dirname(cache_path))
+                    # write a new file and then replace, so no other process
+                    # (or thread) would see it partially written
+                    tmp_path = '%s.tmp-%d-%d' % (
+                        cache_path, os.getpid(),
+                        threading.current_thread().ident)
+                    with open(tmp_path, 'w') as f:
+                        json.dump(value, f)
+                    os.rename(f.name, cache_path)
+                except (IOError, OSError, TypeError) as exc:
+                    lgr.warning("Failed to store cache in %s: %s",
+                                cache_path, exc_str(exc))
+        self._memo[key] = value
+        return value
+
     def _get_conda_env_export(self, root_prefix, conda_path):
+        return self._memoize(
+            'env export', conda_path,
+            lambda: self._run_conda_env_export(root_prefix, conda_path),
+            pip_state=True)
+
+    def _run_conda_env_export(self, root_prefix, conda_path):
         export = {}
         try:
             # NOTE: We need to call conda-env directly.  Conda has problems
@@ -250,6 +536,10 @@ class CondaTracer(DistributionTracer):
         return export
 
     def _get_conda_info(self, conda_path):
+        return self._memoize(
+            'info', conda_path, lambda: self._run_conda_info(conda_path))
+
+    def _run_conda_info(self, conda_path):
         details = {}
         try:
             out, err = self._session.execute_command(
@@ -262,33 +552,67 @@ class CondaTracer(DistributionTracer):
                         conda_path, exc_str(exc))
         return details
 
-    def _get_conda_path(self, path):
-        paths = []
-        conda_path = None
-        while path not in {None, os.path.pathsep, '', '/'}:
-            if path in self._paths_cache:
-                conda_path = self._paths_cache[path]
-                break
-            paths.append(path)
-            try:
-                _, _ = self._session.execute_command(
-                    'ls -ld %s/bin/conda %s/conda-meta'
-                    % (path, path)
-                )
-            except Exception as exc:
-                lgr.debug("Did not detect conda at the path %s: %s", path,
-                          exc_str(exc))
-                path = os.path.dirname(path)  # go to the parent
-                continue
-
-            conda_path = path
-            lgr.info("Detected conda %s", conda_path)
-            break
+    def _probe_conda_paths(self, paths):
+        """Detect conda environments among all ancestor directories of paths
 
+        All the directories which were not probed yet are checked for having
+        bin/conda and conda-meta at once, directly for a local session or
+        with a single ls (per chunk of arguments) otherwise.
+        """
+        dirs = set()
         for path in paths:
-            self._paths_cache[path] = conda_path
+            while path not in {None, os.path.pathsep, '', '/'} \
+                    and path not in dirs:
+                if path not in self._paths_cache:
+                    dirs.add(path)
+                path = os.path.dirname(path)  # go to the parent
+        if not dirs:
+            return
+        probes = [os.path.join(d, f) for d in sorted(dirs)
+                  for f in ('bin/conda', 'conda-meta')]
+        if self._is_local_session():
+            existing = set(filter(os.path.lexists, probes))
+        else:
+            # fails for the probed files which do not exist
+            existing = set(
+                self._run_chunked(['ls', '-1d'], probes).splitlines())
+        for d in dirs:
+            self._paths_cache[d] = \
+                os.path.join(d, 'bin/conda') in existing \
+                and os.path.join(d, 'conda-meta') in existing
+            if self._paths_cache[d]:
+                lgr.info("Detected conda %s", d)
 
-        return conda_path
+    def _get_conda_path(self, path):
+        """Return the closest conda environment containing the path or None
+        """
+        self._probe_conda_paths([path])
+        while path not in {None, os.path.pathsep, '', '/'}:
+            if self._paths_cache.get(path):
+                return path
+            path = os.path.dirname(path)  # go to the parent
+        return None
+
+    def _get_conda_env_details(self, conda_path, files, other_files=()):
+        """Return conda info, details of all (conda and pip) packages and
+        a map of the files to the packages for the conda environment
+
+        `files` are those under the conda path, while `other_files` (outside
+        of any conda path) could be only installed by pip, e.g. in
+        development mode.
+        """
+        conda_info = self._get_conda_info(conda_path)
+        env_export = self._get_conda_env_export(
+            conda_info["root_prefix"], conda_path)
+        (package_details, file_to_pkg) = \
+            self._get_conda_package_details(conda_path, files)
+        (pip_package_details, file_to_pip_pkg) = \
+            self._get_conda_pip_package_details(
+                env_export, conda_path, files.union(other_files))
+        # Join our conda and pip packages
+        package_details.update(pip_package_details)
+        file_to_pkg.update(file_to_pip_pkg)
+        return conda_info, package_details, file_to_pkg
 
     def identify_distributions(self, paths):
         conda_paths = set()
@@ -299,12 +623,32 @@ class CondaTracer(DistributionTracer):
         found_package_count = 0
         total_file_count = len(unknown_files)
 
-        # First, loop through all the files and identify conda paths
+        # First, loop through all the files and route them to the conda
+        # paths containing them
+        self._probe_conda_paths(paths)
+        conda_path_files = defaultdict(list)
+        other_files = []
         for path in paths:
             conda_path = self._get_conda_path(path)
             if conda_path:
-                if conda_path not in conda_paths:
-                    conda_paths.add(conda_path)
+                conda_paths.add(conda_path)
+                conda_path_files[conda_path].append(path)
+            else:
+                other_files.append(path)
+
+        # Sort, so environments are named and files are assigned in the
+        # same order regardless of the order of paths
+        conda_paths = sorted(conda_paths)
+
+        def get_env_details(conda_path):
+            # Files outside of any conda path could still belong to some
+            # package (e.g. installed by pip in development mode)
+            env_files = conda_path_files[conda_path] + other_files
+            return (env_files,) + self._get_conda_env_details(
+                conda_path, set(conda_path_files[conda_path]), other_files)
+
+        # Collect details for all conda_paths (possibly in parallel)
+        all_env_details = self._map(get_env_details, conda_paths)
 
         # Loop through conda_paths, find packages and create the
         # environments
@@ -313,18 +657,9 @@ class CondaTracer(DistributionTracer):
             channels = []
             found_channel_names = set()
 
-            # Retrieve distribution details
-            conda_info = self._get_conda_info(conda_path)
+            (env_files, conda_info, conda_package_details, file_to_pkg) = \
+                all_env_details[idx]
             root_path = conda_info["root_prefix"]
-            env_export = self._get_conda_env_export(
-               root_path, conda_path)
-            (conda_package_details, file_to_pkg) = \
-                self._get_conda_package_details(conda_path)
-            (conda_pip_package_details, file_to_pip_pkg) = \
-                self._get_conda_pip_package_details(env_export, conda_path)
-            # Join our conda and pip packages
-            conda_package_details.update(conda_pip_package_details)
-            file_to_pkg.update(file_to_pip_pkg)
 
             # Initialize a map from packages to files that defaults to []
             pkg_to_found_files = defaultdict(list)
@@ -332,8 +667,8 @@ class CondaTracer(DistributionTracer):
             # Get the conda path prefix to calculate relative paths
             path_prefix = conda_path + os.path.sep
             # Loop through unknown files, assigning them to packages if found
-            for path in set(unknown_files):  # Clone the set
-                if path in file_to_pkg:
+            for path in env_files:
+                if path in unknown_files and path in file_to_pkg:
                     # The file was found so remove from unknown file set
                     unknown_files.remove(path)
                     # Make relative paths if it is begins with the conda path
@@ -403,7 +738,7 @@ class CondaTracer(DistributionTracer):
                  len(unknown_files))
 
         # Find all the identified conda_roots
-        conda_roots = root_to_envs.keys()
+        conda_roots = sorted(root_to_envs)
         # Loop through conda_roots and create the distributions
         for idx, root_path in enumerate(conda_roots):
             # Retrieve distribution details
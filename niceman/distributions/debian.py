@@ -7,7 +7,11 @@
 #
 # ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 """Support for Debian(-based) distribution(s)."""
+import hashlib
+import json
+import mmap
 import os
+import weakref
 from datetime import datetime
 
 import attr
@@ -17,22 +21,54 @@ from six.moves import map
 
 import pytz
 
+from niceman import cfg
 from niceman import utils
 
 from email.utils import mktime_tz, parsedate_tz
 
 import logging
 
-# Pick a conservative max command-line
 from niceman.support.distributions.debian import \
     parse_apt_cache_show_pkgs_output, parse_apt_cache_policy_pkgs_output, \
     parse_apt_cache_policy_source_info, get_apt_release_file_names, \
-    get_spec_from_release_file
+    get_spec_from_release_file, parse_dpkg_list_files_output, \
+    parse_dpkg_diversions, \
+    parse_apt_packages_index
+
+
+def _get_deb_filename(package):
+    """Return the name apt gives to the .deb file of the package"""
+    # apt escapes ':' of the epoch in the file names
+    return '%s_%s_%s.deb' % (package.name,
+                             package.version.replace(':', '%3a'),
+                             package.architecture)
+
+
+def _get_file_sha256(path):
+    """Return hex sha256 digest of the file content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# niceman touches it after a successful apt-get update
+_APT_UPDATE_STAMP = '/var/lib/apt/lists/.niceman-update-stamp'
+
+# Fields identifying the same APT source in different environments (so not
+# the name we assign, or the date of the release which might get updated)
+_APT_SOURCE_MATCH_FIELDS = ('component', 'archive', 'architecture',
+                            'codename', 'origin', 'label', 'site',
+                            'archive_uri')
+
+# Where apt keeps downloaded .deb files, and where it looks for them first
+_APT_ARCHIVES_DIR = '/var/cache/apt/archives'
+
+# Fields of a Release file we need are all in its header, so we do not need
+# to read all the checksums and the signature which follow
+_RELEASE_HEADER_SIZE = 4096
 
-try:
-    _MAX_LEN_CMDLINE = os.sysconf(str("SC_ARG_MAX")) // 2
-except (ValueError, AttributeError):
-    _MAX_LEN_CMDLINE = 2048
 
 # To parse output of dpkg-query
 import re
@@ -41,6 +77,7 @@ _DPKG_QUERY_PARSER = re.compile(
 )
 
 from niceman.distributions.base import DistributionTracer
+from niceman.distributions.base import get_chunks
 
 lgr = logging.getLogger('niceman.distributions.debian')
 
@@ -50,16 +87,18 @@ from .base import Distribution
 from .base import TypedList
 from .base import _register_with_representer
 from ..support.exceptions import CommandError
+from ..support.exceptions import SessionRuntimeError
 #
 # Models
 #
 
-# TODO: flyweight/singleton ?
-# To make them hashable we need to freeze them... not sure if we are ready:
-#@attr.s(cmp=True, hash=True, frozen=True)
-@attr.s(cmp=True)
+@attr.s(cmp=True, hash=True, frozen=True)
 class APTSource(SpecObject):
     """APT origin information
+
+    Instances are immutable and interned, so the same source (with all the
+    same fields) is represented by a single object across all distributions
+    and specs loaded in the process.  Use attr.evolve to get a modified one.
     """
     name = attr.ib()
     component = attr.ib(default=None)
@@ -71,6 +110,26 @@ class APTSource(SpecObject):
     site = attr.ib(default=None)
     archive_uri = attr.ib(default=None)
     date = attr.ib(default=None)
+
+    # values of all fields -> instance
+    _instances = weakref.WeakValueDictionary()
+
+    def __new__(cls, *args, **kwargs):
+        if not (args or kwargs):
+            # e.g. copy or unpickling which would set fields later
+            return super(APTSource, cls).__new__(cls)
+        fields = attr.fields(cls)
+        key = (cls,) + tuple(args) + tuple(
+            kwargs.get(f.name, f.default) for f in fields[len(args):])
+        try:
+            instance = cls._instances.get(key)
+        except TypeError:  # some value is not hashable
+            return super(APTSource, cls).__new__(cls)
+        if instance is None:
+            instance = super(APTSource, cls).__new__(cls)
+            # __init__ would be called on it with the same values
+            cls._instances[key] = instance
+        return instance
 _register_with_representer(APTSource)
 
 
@@ -129,12 +188,71 @@ class DebianDistribution(Distribution):
         environment : object
             The Environment sub-class object.
         """
+        if self._is_apt_updated(session):
+            return
         lgr.debug("Adding Debian update to environment command list.")
         session.execute_command(['apt-get', 'update'])
+        try:
+            session.execute_command(['touch', _APT_UPDATE_STAMP])
+        except CommandError as exc:
+            lgr.debug("Could not record the time of apt-get update: %s", exc)
         #session.execute_command(['apt-get', 'install', '-y', 'python-pip'])
         # session.set_env(DEBIAN_FRONTEND='noninteractive', this_session_only=True)
 
-    def install_packages(self, session, use_version=True):
+    def _is_apt_updated(self, session):
+        """Return True if there is no need to run apt-get update
+
+        That is if niceman ran it within the last "apt update ttl" minutes
+        (configurable in the debian section), or if APT has indexes for all
+        the apt_sources of the spec already.
+        """
+        ttl = cfg.get_as_dtype('debian', 'apt update ttl', int, default=60)
+        if ttl > 0:
+            try:
+                out, _ = session.execute_command(
+                    ['find', os.path.dirname(_APT_UPDATE_STAMP),
+                     '-maxdepth', '1',
+                     '-name', os.path.basename(_APT_UPDATE_STAMP),
+                     '-mmin', '-%d' % ttl]
+                )
+            except CommandError as exc:
+                lgr.debug("Could not check the time of apt-get update: %s",
+                          exc)
+            else:
+                # output might carry errors or warnings (e.g. merged stderr)
+                lines = utils.to_unicode(out, "utf-8").splitlines()
+                if _APT_UPDATE_STAMP in lines:
+                    lgr.debug("Skipping apt-get update since it was run "
+                              "within last %d minutes", ttl)
+                    return True
+        # dpkg status is always known, but tells nothing about the indexes
+        apt_sources = [src for src in self.apt_sources
+                       if src.archive_uri != '/var/lib/dpkg/status']
+        if apt_sources and self._has_apt_sources(session, apt_sources):
+            lgr.debug("Skipping apt-get update since all %d APT sources "
+                      "are known already", len(apt_sources))
+            return True
+        return False
+
+    @staticmethod
+    def _has_apt_sources(session, apt_sources):
+        """Return True if APT has indexes for all the apt_sources"""
+        try:
+            out, _ = session.execute_command(['apt-cache', 'policy'])
+        except CommandError as exc:
+            lgr.debug("Could not query APT sources: %s", exc)
+            return False
+        known = set(
+            tuple(src_info.get(f) for f in _APT_SOURCE_MATCH_FIELDS)
+            for src_info in parse_apt_cache_policy_source_info(
+                utils.to_unicode(out, "utf-8")).values()
+        )
+        return all(
+            tuple(getattr(src, f) for f in _APT_SOURCE_MATCH_FIELDS) in known
+            for src in apt_sources
+        )
+
+    def install_packages(self, session, use_version=True, incremental=True):
         """
         Install the packages associated to this distribution by the provenance
         into the environment.
@@ -145,16 +263,44 @@ class DebianDistribution(Distribution):
         use_version : bool, optional
           Use version information if provided.
           TODO: support outside or deprecate
-            
+        incremental : bool, optional
+          Install only the packages which are not yet installed (as
+          specified), as determined by a single query of installed packages.
         """
+        packages = self.packages
+        if incremental:
+            packages = self._get_packages_to_install(session, use_version)
+            if not packages:
+                lgr.info("All %d packages are installed already",
+                         len(self.packages))
+                return
         package_specs = []
 
-        for package in self.packages:
+        for package in packages:
             package_spec = package.name
             if use_version and package.version:
                 package_spec += '=%s' % package.version
             package_specs.append(package_spec)
 
+        # Only the packages with known checksums could be shared safely
+        # across environments
+        cached_packages = [
+            p for p in packages
+            if use_version and p.version and p.architecture and p.sha256]
+        cache_dir = self._get_deb_cache_dir() if cached_packages else None
+        if cache_dir:
+            self._put_cached_debs(session, cache_dir, cached_packages)
+            # Download separately, so we could collect the debs before
+            # they get cleaned up (e.g. by docker-clean hook) upon install
+            try:
+                session.execute_command(
+                    ['apt-get', 'install', '-y', '--download-only']
+                    + package_specs)
+            except CommandError as exc:
+                lgr.debug("Failed to download packages: %s", exc)
+            else:
+                self._get_downloaded_debs(session, cache_dir, cached_packages)
+
         # Doing in one shot to fail early if any of the versioned specs
         # couldn't be satisfied
         lgr.debug("Installing %s", ', '.join(package_specs))
@@ -164,7 +310,174 @@ class DebianDistribution(Distribution):
             # env={'DEBIAN_FRONTEND': 'noninteractive'}
         )
 
+    @staticmethod
+    def _get_deb_cache_dir():
+        """Return the directory of .deb files cache on the host, or None
+
+        The cache is shared across all the environments niceman installs
+        packages into.
+        """
+        if not cfg.getboolean('debian', 'use deb cache', default=True):
+            return None
+        return cfg.getpath(
+            'debian', 'deb cache dir',
+            default=os.path.join(cfg.dirs.user_cache_dir, 'debian', 'debs'))
+
+    @staticmethod
+    def _get_cached_deb_path(cache_dir, package):
+        """Return path of the package .deb within the host cache"""
+        return os.path.join(
+            cache_dir, package.name,
+            '%s_%s.deb' % (_get_deb_filename(package)[:-4], package.sha256))
+
+    def _put_cached_debs(self, session, cache_dir, packages):
+        """Copy debs of the packages available in the cache into the session
+
+        apt-get then uses them instead of downloading, as long as they match
+        the checksums in its lists.
+        """
+        nput = 0
+        for package in packages:
+            path = self._get_cached_deb_path(cache_dir, package)
+            if not os.path.exists(path):
+                continue
+            try:
+                session.put(path, '%s/%s' % (_APT_ARCHIVES_DIR,
+                                             _get_deb_filename(package)))
+            except NotImplementedError:
+                lgr.debug("%s does not support copying files in", session)
+                return
+            except (CommandError, IOError, OSError) as exc:
+                lgr.debug("Failed to copy %s into the session: %s", path, exc)
+                continue
+            nput += 1
+        lgr.info("Reused %d out of %d packages from %s",
+                 nput, len(packages), cache_dir)
+
+    def _get_downloaded_debs(self, session, cache_dir, packages):
+        """Copy debs of the packages downloaded in the session into the cache
+
+        Only the debs matching the sha256 of the package are kept.
+        """
+        packages = [p for p in packages
+                    if not os.path.exists(
+                        self._get_cached_deb_path(cache_dir, p))]
+        if not packages:
+            return
+        try:
+            out, _ = session.execute_command(
+                ['find', _APT_ARCHIVES_DIR, '-maxdepth', '1',
+                 '-name', '*.deb', '-printf', '%f\\n'])
+        except CommandError as exc:
+            lgr.debug("Failed to list downloaded packages: %s", exc)
+            return
+        downloaded = set(utils.to_unicode(out, "utf-8").splitlines())
+        nget = 0
+        for package in packages:
+            filename = _get_deb_filename(package)
+            if filename not in downloaded:
+                continue
+            path = self._get_cached_deb_path(cache_dir, package)
+            utils.assure_dir(os.path.dirname(path))
+            # so a partial copy never ends up in the cache
+            temp_path = '%s.%d.tmp' % (path, os.getpid())
+            try:
+                session.get('%s/%s' % (_APT_ARCHIVES_DIR, filename),
+                            temp_path)
+            except NotImplementedError:
+                lgr.debug("%s does not support copying files out", session)
+                return
+            except (CommandError, IOError, OSError) as exc:
+                lgr.debug("Failed to copy %s from the session: %s",
+                          filename, exc)
+                continue
+            try:
+                if _get_file_sha256(temp_path) == package.sha256:
+                    os.rename(temp_path, path)
+                    nget += 1
+                    continue
+                lgr.warning("Not caching %s since its sha256 does not match "
+                            "the package", filename)
+            except (IOError, OSError) as exc:
+                lgr.debug("Failed to cache %s: %s", filename, exc)
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+        lgr.debug("Cached %d new packages under %s", nget, cache_dir)
+
+    def verify_packages(self, session):
+        """Verify that the packages are installed in the session
+
+        All installed packages are listed with a single dpkg-query call and
+        compared against the specified ones by name.
+
+        Parameters
+        ----------
+        session : object
+            Session to work in
+
+        Returns
+        -------
+        list of DEBPackage
+            Packages which are not installed as specified
+        """
+        installed = self._get_installed(session)
+
+        def get_spec(p):
+            return DebTracer._get_pkg_query(p.name, p.architecture) \
+                + ('=%s' % p.version if p.version else '')
+
+        failed = self - installed
+        installed_index = installed._get_packages_index()
+        for package in failed:
+            others = installed_index.get(package.name)
+            if others:
+                lgr.warning("Package %s is installed as %s", get_spec(package),
+                            ', '.join(map(get_spec, others)))
+            else:
+                lgr.warning("Package %s is not installed", get_spec(package))
+        return failed
+
+    def _get_installed(self, session):
+        """Return DebianDistribution with all packages installed in session
+
+        A single dpkg-query call is used regardless of the number of packages.
+        """
+        out, _ = session.execute_command(
+            ['dpkg-query', '-W',
+             '-f=${db:Status-Abbrev} ${Package}:${Architecture}=${Version}\\n']
+        )
+        installed = DebianDistribution(name=self.name)
+        for line in utils.to_unicode(out, "utf-8").splitlines():
+            status, _, query = line.rpartition(' ')
+            # the second letter is the current status, the first one is only
+            # the desired action (e.g. 'h' for hold)
+            if status[1:2] != 'i':
+                continue  # e.g. only unpacked or configuration files are left
+            name, _, version = query.partition('=')
+            name, _, architecture = name.partition(':')
+            installed.packages.append(
+                DEBPackage(name=name, version=version,
+                           architecture=architecture or None))
+        return installed
+
+    def _get_packages_to_install(self, session, use_version=True):
+        """Return packages which are not installed (as specified) yet"""
+        try:
+            installed = self._get_installed(session)
+        except CommandError as exc:
+            lgr.debug("Could not query installed packages, will install all "
+                      "of them: %s", exc)
+            return self.packages
+        if use_version:
+            return self - installed
+        index = installed._get_packages_index()
+        return [p for p in self.packages
+                if not self._satisfies_package(
+                    index, attr.evolve(p, version=None))]
+
     def normalize(self):
+        # Sources are hashable, so we can just drop exact duplicates
+        self.apt_sources = utils.unique(self.apt_sources)
         # TODO:
         # - among apt-source we could merge some together if we allow for
         #   e.g. component (main, contrib, non-free) to be a list!  but that
@@ -178,7 +491,7 @@ class DebianDistribution(Distribution):
             raise TypeError('satisfies_package() requires a package argument')
         if not isinstance(package, DEBPackage):
             return False
-        return any([ p.satisfies(package) for p in self.packages ])
+        return any(p.satisfies(package) for p in self.packages)
 
     def satisfies(self, other):
         """return True if this distribution (self) satisfies the requirements 
@@ -187,14 +500,40 @@ class DebianDistribution(Distribution):
             raise TypeError('satisfies() requires a distribution argument')
         if not isinstance(other, DebianDistribution):
             return False
-        return all(map(self.satisfies_package, other.packages))
+        index = self._get_packages_index()
+        return all(self._satisfies_package(index, p) for p in other.packages)
 
     def __sub__(self, other):
         # the semantics of distribution subtraction are, for d1 - d2:
         #     what is specified in d1 that is not specified in d2
         #     or how does d2 fall short of d1
         #     or what is in d1 that isn't satisfied by d2
-        return [ p for p in self.packages if not other.satisfies_package(p) ]
+        if not isinstance(other, DebianDistribution):
+            return [p for p in self.packages
+                    if not other.satisfies_package(p)]
+        index = other._get_packages_index()
+        return [p for p in self.packages
+                if not self._satisfies_package(index, p)]
+
+    def _get_packages_index(self):
+        """Return dict name -> [DEBPackage] for packages of this distribution
+
+        Only packages with the same name can satisfy each other, so it allows
+        to compare large distributions without looking at all pairs of
+        packages.  It is built anew for every comparison, since packages
+        could be modified in place at any time.
+        """
+        packages_by_name = defaultdict(list)
+        for p in self.packages:
+            packages_by_name[p.name].append(p)
+        return packages_by_name
+
+    @staticmethod
+    def _satisfies_package(index, package):
+        """Return True if packages in the index satisfy the package"""
+        if not isinstance(package, DEBPackage):
+            return False
+        return any(p.satisfies(package) for p in index.get(package.name, []))
 
     # to grow:
     #  def __iadd__(self, another_instance or DEBPackage, or APTSource)
@@ -212,7 +551,6 @@ class DebTracer(DistributionTracer):
     # The Debian tracer is not designed to handle directories
     HANDLES_DIRS = False
 
-    # TODO: (Low Priority) handle cases from dpkg-divert
     def _init(self):
         # TODO: we might want a generic helper for collections of things
         # where we could match based on the set of attrs which matter
@@ -220,6 +558,31 @@ class DebTracer(DistributionTracer):
         self._apt_source_names = set()
         self._all_apt_sources = {}
         self._source_line_to_name_map = {}
+        # Details collected in bulk by _prefetch_packages.  Known to be
+        # missing entries are stored with None value
+        self._pkgs_arch_and_version = {}  # query -> (architecture, version)
+        self._pkgs_details = {}  # name:arch=version -> apt-cache show record
+        self._pkgs_versions = {}  # query -> apt-cache policy record
+        # path -> [packagefields] as loaded from the dpkg database.
+        # False if it could not be loaded
+        self._dpkg_index = None
+        # name or name:arch -> install date for all packages.  False if
+        # could not be collected
+        self._install_dates = None
+        # Release file path -> DebianReleaseSpec, None if file is missing.
+        # Many APT sources share the same Release file
+        self._release_specs = {}
+        # top directory -> its alias, in both directions, for directories
+        # symlinked on merged-/usr systems (e.g. /bin <-> /usr/bin)
+        self._dir_aliases = None
+        # path -> (from, to, package) for both paths of every dpkg diversion
+        self._diversions = None
+        # cache file for the current state of dpkg and apt within the
+        # session.  False if caching is not used
+        self._cache_path = None
+        # content of the cache file, loaded once and saved at the end
+        self._cache = None
+        self._cache_changed = False
 
     def identify_distributions(self, files):
         if not files:
@@ -240,6 +603,7 @@ class DebTracer(DistributionTracer):
             return
 
         packages, remaining_files = self.identify_packages_from_files(files)
+        self._save_cache()
         # TODO: add option to report distribution even if no packages/files
         # found association
         if not packages:
@@ -260,18 +624,259 @@ class DebTracer(DistributionTracer):
         yield dist, remaining_files
 
     def _get_packagefields_for_files(self, files):
+        index = self._get_dpkg_index()
+        if not index:
+            return self._query_packagefields_for_files(files)
+
         file_to_package_dict = {}
+        for f in files:
+            pkgs = index.get(f)
+            if not pkgs:
+                # dpkg might know it under the other name on merged-/usr
+                for alias in self._get_path_aliases(f):
+                    pkgs = index.get(alias)
+                    if pkgs:
+                        break
+            if pkgs:
+                # as dpkg-query does report, we go with the first one
+                if len(pkgs) > 1:
+                    lgr.warning("File %s belongs to multiple packages (%s)",
+                                f, ', '.join(self._get_pkg_query(**pkg)
+                                             for pkg in pkgs))
+                lgr.debug("Identified file %r to belong to package %s",
+                          f, pkgs[0])
+                file_to_package_dict[f] = pkgs[0]
+        return file_to_package_dict
+
+    def _get_dpkg_index(self):
+        if self._dpkg_index is None:
+            cached = self._load_from_cache('dpkg_index')
+            if cached is not None:
+                pkgs = {}  # so packagefields are shared as when loaded
+                self._dpkg_index = {}
+                for path, path_pkgs in cached.items():
+                    for pkg in map(tuple, path_pkgs):
+                        if pkg not in pkgs:
+                            pkgs[pkg] = self._get_pkgfields(*pkg)
+                        self._dpkg_index.setdefault(path, []).append(pkgs[pkg])
+                return self._dpkg_index
+            try:
+                self._dpkg_index = self._load_dpkg_index()
+            except (CommandError, SessionRuntimeError) as exc:
+                lgr.debug("Could not load dpkg database, will use "
+                          "dpkg-query: %s", exc)
+                self._dpkg_index = False
+            else:
+                self._store_in_cache('dpkg_index', {
+                    path: [(pkg['name'], pkg.get('architecture'))
+                           for pkg in path_pkgs]
+                    for path, path_pkgs in self._dpkg_index.items()
+                })
+        return self._dpkg_index
+
+    @staticmethod
+    def _get_pkgfields(name, architecture=None):
+        pkg = {'name': name}
+        if architecture:
+            pkg['architecture'] = architecture
+        return pkg
 
-        # Find out how many files we can query at once
-        max_len = max([len(f) for f in files])
-        num_files = max((_MAX_LEN_CMDLINE - 13) // (max_len + 1), 1)
+    def _get_cache_path(self):
+        """Return path to the cache file for the current state of the dpkg
+        database and APT lists in the session, or None if not to be cached
+        """
+        if self._cache_path is None:
+            self._cache_path = False
+            if not cfg.getboolean('debian', 'use cache', default=True):
+                return None
+            try:
+                out, _ = self._session.execute_command(
+                    ['stat', '-c', '%n %s %Y',
+                     '/var/lib/dpkg/status', '/var/lib/dpkg/diversions',
+                     '/var/lib/apt/lists'])
+            except CommandError as exc:
+                # e.g. there is no apt lists -- the rest still identifies
+                out = exc.stdout
+            out = utils.to_unicode(out, "utf-8")
+            if out.strip():
+                self._cache_path = os.path.join(
+                    cfg.getpath('debian', 'cache dir',
+                                default=os.path.join(
+                                    cfg.dirs.user_cache_dir, 'debian')),
+                    hashlib.md5(out.encode('utf-8')).hexdigest() + '.json')
+        return self._cache_path or None
+
+    def _load_cache(self):
+        """Return content of the cache file, loaded only once"""
+        if self._cache is None:
+            self._cache = {}
+            path = self._get_cache_path()
+            if path and os.path.exists(path):
+                try:
+                    with open(path) as f:
+                        self._cache = json.load(f)
+                except (IOError, ValueError) as exc:
+                    lgr.warning("Failed to load cache from %s: %s", path, exc)
+        return self._cache
+
+    def _load_from_cache(self, section):
+        """Return cached value for the section or None if not cached"""
+        value = self._load_cache().get(section)
+        if value is not None:
+            lgr.debug("Using cached %s from %s", section, self._cache_path)
+        return value
+
+    def _store_in_cache(self, section, value):
+        """Store value for the section, to be saved by _save_cache"""
+        if not self._get_cache_path():
+            return
+        self._load_cache()[section] = value
+        self._cache_changed = True
+
+    def _save_cache(self):
+        """Save the cache file if anything was stored in it"""
+        if not self._cache_changed:
+            return
+        path = self._get_cache_path()
+        try:
+            utils.assure_dir(os.path.dirname(path))
+            # write a new file and then replace, so no other process would
+            # see it partially written
+            with open(path + '.tmp-%d' % os.getpid(), 'w') as f:
+                json.dump(self._cache, f)
+            os.rename(f.name, path)
+        except (IOError, OSError) as exc:
+            lgr.warning("Failed to store cache in %s: %s", path, exc)
+        self._cache_changed = False
+
+    def _load_dpkg_index(self):
+        """Load the path -> [packagefields] index from the dpkg database
+
+        Only two commands are run regardless of the number of packages: one to
+        read the status file, and one to dump all info/*.list files.
+        """
+        status = parse_apt_cache_show_pkgs_output(
+            utils.to_unicode(self._session.read('/var/lib/dpkg/status'),
+                             "utf-8"))
+        not_installed = set()
+        multiarch_same = defaultdict(list)  # name -> [architecture]
+        for info in status.values():
+            name = info["Package"]
+            if info.get("Status", "").endswith(" not-installed"):
+                not_installed.add(name)
+            elif info.get("Multi-Arch") == "same":
+                multiarch_same[name].append(info.get("Architecture"))
+
+        out, _ = self._session.execute_command(
+            ['find', '/var/lib/dpkg/info', '-name', '*.list',
+             '-exec', 'awk', 'FNR == 1 {print "\\t" FILENAME} {print}',
+             '{}', '+']
+        )
+        out = utils.to_unicode(out, "utf-8")
+
+        index = defaultdict(list)
+        pkgs = {}  # (name, architecture) -> shared packagefields
+        for name, architecture, path in parse_dpkg_list_files_output(out):
+            if name in not_installed:
+                continue
+            if not architecture and len(multiarch_same.get(name, [])) == 1:
+                # dpkg-query reports architecture for Multi-Arch: same
+                # packages even if the database is not multiarch aware yet
+                architecture = multiarch_same[name][0]
+            key = (name, architecture)
+            if key not in pkgs:
+                pkgs[key] = self._get_pkgfields(name, architecture)
+            index[path].append(pkgs[key])
+        # Diverted files are listed by packages under their original names
+        diversions = self._get_diversions()
+        diverted = {
+            path: self._get_diverted_owners(
+                path, diversion, index.get(diversion[0], []))
+            for path, diversion in diversions.items()
+        }
+        for path, owners in diverted.items():
+            if owners:
+                index[path] = owners
+            else:
+                index.pop(path, None)
+        lgr.debug("Loaded dpkg database with %d packages, %d paths and "
+                  "%d diversions", len(pkgs), len(index), len(diversions) // 2)
+        return dict(index)
+
+    def _get_diversions(self):
+        """Return path -> (from, to, package) for all diversions
+
+        The table is loaded once from /var/lib/dpkg/diversions, and both
+        paths of each diversion are mapped to it.
+        """
+        if self._diversions is None:
+            self._diversions = {}
+            try:
+                content = self._session.read('/var/lib/dpkg/diversions')
+            except (CommandError, SessionRuntimeError) as exc:
+                lgr.debug("Could not load dpkg diversions: %s", exc)
+                return self._diversions
+            for diversion in parse_dpkg_diversions(
+                    utils.to_unicode(content, "utf-8")):
+                self._diversions[diversion[0]] = diversion
+                self._diversions[diversion[1]] = diversion
+        return self._diversions
+
+    @staticmethod
+    def _get_diverted_owners(path, diversion, owners):
+        """Return packagefields of packages owning a diverted path
 
-        for subfiles in (files[pos:pos + num_files]
-                         for pos in range(0, len(files), num_files)):
-            out = self._run_dpkg_query(subfiles)
+        Parameters
+        ----------
+        path : str
+          Either of the paths of the diversion
+        diversion : tuple
+          (from, to, package)
+        owners : list
+          packagefields of all packages which list the original (from) path
+        """
+        from_, _, package = diversion
+        if path == from_:
+            # the file of the diverting package, or of the administrator
+            # for a local diversion
+            return [p for p in owners if p['name'] == package]
+        # the file of any other package, moved out of the way
+        return [p for p in owners if p['name'] != package]
 
+    def _query_packagefields_for_files(self, files):
+        """Use dpkg-query -S to find packages files belong to"""
+        file_to_package_dict = {}
+        # dpkg might know files under the other name on merged-/usr, so
+        # we query for those too
+        alias_to_files = defaultdict(list)
+        for f in files:
+            for alias in self._get_path_aliases(f):
+                alias_to_files[alias].append(f)
+        aliases = sorted(set(alias_to_files).difference(files))
+        found_by_alias = {}
+        # dpkg-query reports all the packages listing the original path of a
+        # diverted file, so we ask about it and resolve from the diversions
+        diversions = self._get_diversions()
+        queries = files + aliases
+        diverted = [q for q in queries if q in diversions]
+        diverted_from = set(diversions[q][0] for q in diverted)
+        diverted_from_owners = {}
+        queries = [q for q in queries if q not in diversions] + \
+            sorted(diverted_from)
+
+        for out in self._map(self._run_dpkg_query,
+                             get_chunks(queries, len('dpkg-query -S'))):
             # Now go through the output and assign packages to files
             for outline in out.splitlines():
+                names, _, path = outline.partition(': ')
+                if self._is_diversion_line(outline):
+                    continue  # resolved from the diversions table
+                if path in diverted_from:
+                    diverted_from_owners[path] = [
+                        self._get_pkgfields(*name.strip().split(':', 1))
+                        for name in names.split(',')
+                    ]
+                    continue
                 # Parse package name (architecture) and path
                 # TODO: Handle query of /bin/sh better
                 outdict = self._parse_dpkgquery_line(outline)
@@ -285,13 +890,78 @@ class DebTracer(DistributionTracer):
                         "Record %s got no path defined... skipping"
                         % repr(outdict)
                     )
+                for f in alias_to_files.get(found_name, []):
+                    found_by_alias[f] = outdict
                 # Associate the file to the package name (and architecture)
                 pkg = outdict
                 lgr.debug("Identified file %r to belong to package %s",
                           found_name, pkg)
                 file_to_package_dict[found_name] = pkg
+        for q in diverted:
+            owners = self._get_diverted_owners(
+                q, diversions[q], diverted_from_owners.get(diversions[q][0], []))
+            if owners:
+                lgr.debug("Identified diverted file %r to belong to "
+                          "package %s", q, owners[0])
+                file_to_package_dict[q] = owners[0]
+                for f in alias_to_files.get(q, []):
+                    found_by_alias[f] = owners[0]
+        # but files known to dpkg under their own name take precedence
+        for f, pkg in found_by_alias.items():
+            if f not in file_to_package_dict:
+                lgr.debug("Identified file %r to belong to package %s",
+                          f, pkg)
+                file_to_package_dict[f] = pkg
+        # we were not asked about aliases themselves
+        for alias in aliases:
+            file_to_package_dict.pop(alias, None)
         return file_to_package_dict
 
+    def _get_dir_aliases(self):
+        """Return top directory -> its alias for symlinked top directories
+
+        On merged-/usr systems /bin, /sbin and /lib* are symlinks into /usr,
+        so a file could be known to dpkg and to us under different names.
+        Symlinks are resolved once with a single call.
+        """
+        if self._dir_aliases is not None:
+            return self._dir_aliases
+        self._dir_aliases = {}
+        try:
+            out, _ = self._session.execute_command(
+                ['find', '/', '-maxdepth', '1', '-type', 'l',
+                 '(', '-name', 'bin', '-o', '-name', 'sbin',
+                 '-o', '-name', 'lib*', ')',
+                 '-printf', '%p\\t%l\\n']
+            )
+        except CommandError as exc:
+            lgr.debug("Could not resolve top directories symlinks: %s", exc)
+            return self._dir_aliases
+        for line in utils.to_unicode(out, "utf-8").splitlines():
+            path, _, target = line.partition('\t')
+            if not target:
+                continue
+            target = os.path.normpath(os.path.join('/', target))
+            if target == path or os.path.dirname(target) == '/':
+                continue  # not a merged-/usr kind of a symlink
+            self._dir_aliases[path] = target
+            self._dir_aliases[target] = path
+        return self._dir_aliases
+
+    def _get_path_aliases(self, path):
+        """Return other names of the path on merged-/usr systems"""
+        aliases = self._get_dir_aliases()
+        if not aliases:
+            return []
+        # aliased directories are at most two levels deep, e.g. /usr/bin
+        parts = path.split('/', 3)
+        return [
+            alias + path[len(d):]
+            for d in ('/'.join(parts[:2]), '/'.join(parts[:3]))
+            if len(path) > len(d) and d in aliases
+            for alias in (aliases[d],)
+        ]
+
     def _get_apt_source_name(self, src):
         # Create a unique name for the origin
         name_fmt = "apt_%s_%s_%s_%%d" % (src.origin or "", src.archive or "",
@@ -321,7 +991,7 @@ class DebTracer(DistributionTracer):
             return None
 
         # Get install date from the modify time of the dpkg info file
-        install_date = self._get_pkg_install_date(name)
+        install_date = self._get_pkg_install_date(name, architecture)
 
         # Now use "apt-cache policy pkg:arch" to get versions
         ver_dict = self._get_pkg_versions_and_sources(name, architecture)
@@ -343,7 +1013,142 @@ class DebTracer(DistributionTracer):
             versions=ver_dict
         )
 
+    @staticmethod
+    def _get_pkg_query(name, architecture=None):
+        return name if not architecture else "%s:%s" % (name, architecture)
+
+    def _prefetch_packages(self, packagefields):
+        if not packagefields:
+            return
+        # Identify packages by name and architecture, and query them in
+        # their order, so the same packages always result in the same
+        # batches regardless of the order in which they were found
+        unique_fields = {}
+        for fields in packagefields:
+            unique_fields.setdefault(
+                (fields['name'], fields.get('architecture') or ''), fields)
+        packagefields = [unique_fields[key] for key in sorted(unique_fields)]
+        queries = [self._get_pkg_query(**fields) for fields in packagefields]
+
+        # "dpkg -s" for installed architectures and versions
+        installed = defaultdict(list)  # name -> [(architecture, version)]
+        for info in parse_apt_cache_show_pkgs_output(
+                self._run_chunked(['dpkg', '-s'], queries)).values():
+            installed[info["Package"]].append(
+                (info.get("Architecture"), info["Version"]))
+        for fields, query in zip(packagefields, queries):
+            candidates = [
+                (arch, version) for arch, version in installed[fields['name']]
+                if fields.get('architecture') in (None, arch)
+            ]
+            # if ambiguous -- leave it to be queried separately
+            if len(candidates) <= 1:
+                self._pkgs_arch_and_version[query] = \
+                    candidates[0] if candidates else (None, None)
+        found = []  # (name, architecture, version) of installed packages
+        for fields, query in zip(packagefields, queries):
+            architecture, version = \
+                self._pkgs_arch_and_version.get(query, (None, None))
+            if version:
+                found.append((fields['name'], architecture, version))
+        if not found:
+            return
+
+        # Details of those particular versions from the APT lists, or
+        # "apt-cache show" if not found there
+        details_queries = [
+            "%s=%s" % (self._get_pkg_query(name, architecture), version)
+            for name, architecture, version in found
+        ]
+        details = self._get_pkgs_details_from_apt_lists(
+            set(name for name, _, _ in found))
+        missing_queries = [q for q in details_queries if q not in details]
+        if missing_queries:
+            details.update(parse_apt_cache_show_pkgs_output(
+                self._run_chunked(['apt-cache', 'show'], missing_queries)))
+        for query in details_queries:
+            self._pkgs_details[query] = details.get(query)
+
+        # "apt-cache policy" for versions and sources.  Its output is
+        # identified by the package name only, so we run separate rounds for
+        # the same package of multiple architectures
+        rounds = []
+        for name, architecture, _ in found:
+            query = self._get_pkg_query(name, architecture)
+            for round_ in rounds:
+                if name not in round_:
+                    round_[name] = query
+                    break
+            else:
+                rounds.append({name: query})
+        for round_ in rounds:
+            versions = parse_apt_cache_policy_pkgs_output(
+                self._run_chunked(['apt-cache', 'policy'],
+                                  list(round_.values())))
+            for name, query in round_.items():
+                self._pkgs_versions[query] = versions.get(name)
+
+    def _get_apt_packages_indexes(self):
+        """Return paths of all (uncompressed) Packages indexes of APT"""
+        try:
+            out, _ = self._session.execute_command(
+                ['find', '/var/lib/apt/lists', '-maxdepth', '1',
+                 '-name', '*_Packages']
+            )
+        except CommandError as exc:
+            lgr.debug("Could not find APT Packages indexes: %s", exc)
+            return []
+        return sorted(utils.to_unicode(out, "utf-8").split())
+
+    def _read_apt_packages_index(self, path):
+        """Generate lines of the index, memory-mapped if it is local"""
+        if not self._is_local_session():
+            for line in utils.to_unicode(
+                    self._session.read(path), "utf-8").splitlines():
+                yield line
+            return
+        if not os.path.getsize(path):
+            return  # mmap cannot map an empty file
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for line in iter(mm.readline, b''):
+                    yield line.decode('utf-8')
+            finally:
+                mm.close()
+
+    def _get_pkgs_details_from_apt_lists(self, names):
+        """Collect records for the packages from APT Packages indexes
+
+        Returns
+        -------
+        dict
+          name:arch=version -> record, as provided by apt-cache show
+        """
+        details = {}
+        for path in self._get_apt_packages_indexes():
+            try:
+                for pkg in parse_apt_packages_index(
+                        self._read_apt_packages_index(path), names):
+                    if "Version" not in pkg:
+                        continue
+                    query = "%s=%s" % (
+                        self._get_pkg_query(pkg["Package"],
+                                            pkg.get("Architecture")),
+                        pkg["Version"])
+                    # the same version might come from multiple archives
+                    details.setdefault(query, pkg)
+            except (CommandError, IOError, OSError, ValueError) as exc:
+                lgr.warning("Failed to read APT Packages index %s: %s",
+                            path, exc)
+        return details
+
     def _find_all_sources(self):
+        cached = self._load_from_cache('apt_sources')
+        if cached is not None:
+            for src_name, src_fields in cached.items():
+                self._all_apt_sources[src_name] = APTSource(**src_fields)
+            return
         # Use apt-cache policy to get all sources
         out, _ = self._session.execute_command(
             ['apt-cache', 'policy']
@@ -367,11 +1172,16 @@ class DebTracer(DistributionTracer):
                     site=src_vals.get("site"),
                     date=date,
                     archive_uri=src_vals.get("archive_uri"))
+        self._store_in_cache('apt_sources', {
+            src_name: attr.asdict(src)
+            for src_name, src in self._all_apt_sources.items()
+        })
 
     def _get_pkg_arch_and_version(self, name, architecture):
         # Use "dpkg -s pkg" to get the installed version and arch
-        query = name if not architecture \
-            else "%s:%s" % (name, architecture)
+        query = self._get_pkg_query(name, architecture)
+        if query in self._pkgs_arch_and_version:
+            return self._pkgs_arch_and_version[query]
         try:
             out, _ = self._session.execute_command(
                 ['dpkg', '-s', query]
@@ -391,8 +1201,9 @@ class DebTracer(DistributionTracer):
 
     def _get_pkg_details(self, name, architecture, version):
         # Now use "apt-cache show pkg:arch=version" to get more detail
-        query = "%s=%s" % (name, version) if not architecture \
-            else "%s:%s=%s" % (name, architecture, version)
+        query = "%s=%s" % (self._get_pkg_query(name, architecture), version)
+        if query in self._pkgs_details:
+            return self._pkgs_details[query]
         try:
             out, _ = self._session.execute_command(
                 ['apt-cache', 'show', query]
@@ -406,14 +1217,50 @@ class DebTracer(DistributionTracer):
             return None
         return info
 
-    def _get_pkg_install_date(self, name):
+    @staticmethod
+    def _get_date_from_timestamp(timestamp):
+        return str(
+            pytz.utc.localize(
+                datetime.utcfromtimestamp(float(timestamp))))
+
+    def _get_install_dates(self):
+        """Return install dates for all packages, collected at once
+
+        Install date is the modification time of the package's info/*.list
+        file
+        """
+        if self._install_dates is None:
+            try:
+                out, _ = self._session.execute_command(
+                    ['find', '/var/lib/dpkg/info', '-name', '*.list',
+                     '-printf', '%T@ %f\\n']
+                )
+            except CommandError as exc:
+                lgr.debug("Could not collect install dates of all packages: "
+                          "%s", exc)
+                self._install_dates = False
+                return self._install_dates
+            self._install_dates = {}
+            for line in utils.to_unicode(out, "utf-8").splitlines():
+                if not line.endswith('.list'):
+                    continue
+                mtime, filename = line.split(' ', 1)
+                # sub-second precision was never reported
+                self._install_dates[filename[:-len('.list')]] = \
+                    self._get_date_from_timestamp(mtime.split('.')[0])
+        return self._install_dates
+
+    def _get_pkg_install_date(self, name, architecture=None):
+        install_dates = self._get_install_dates()
+        if install_dates is not False:
+            # info files of Multi-Arch: same packages carry the architecture
+            return install_dates.get(self._get_pkg_query(name, architecture),
+                                     install_dates.get(name))
         try:
             out, _ = self._session.execute_command(
                 ['stat', '-c', '%Y', "/var/lib/dpkg/info/" + name + ".list"]
             )
-            install_date = str(
-                pytz.utc.localize(
-                    datetime.utcfromtimestamp(float(out))))
+            install_date = self._get_date_from_timestamp(out)
         except CommandError:  # file not found
             install_date = None
             pass
@@ -421,17 +1268,20 @@ class DebTracer(DistributionTracer):
         return install_date
 
     def _get_pkg_versions_and_sources(self, name, architecture):
-        query = name if not architecture \
-            else "%s:%s" % (name, architecture)
-        out, _ = self._session.execute_command(
-            ['apt-cache', 'policy', query]
-        )
-        out = utils.to_unicode(out, "utf-8")
-        # dpkg -s uses the same output as apt-cache show pkg
-        ver = parse_apt_cache_policy_pkgs_output(out)
+        query = self._get_pkg_query(name, architecture)
+        if query in self._pkgs_versions:
+            ver = self._pkgs_versions[query]
+        else:
+            out, _ = self._session.execute_command(
+                ['apt-cache', 'policy', query]
+            )
+            out = utils.to_unicode(out, "utf-8")
+            # dpkg -s uses the same output as apt-cache show pkg
+            ver = parse_apt_cache_policy_pkgs_output(out)
+            if ver:
+                _, ver = ver.popitem()  # Pull out first (and only) result
         if not ver:
             return None
-        _, ver = ver.popitem()  # Pull out first (and only) result
         ver_dict = {}
         for v in ver.get("versions"):
             key = v.get("version")
@@ -447,7 +1297,7 @@ class DebTracer(DistributionTracer):
                     # Grab and name the source
                     source = self._all_apt_sources[s]
                     src_name = self._get_apt_source_name(source)
-                    source.name = src_name
+                    source = attr.evolve(source, name=src_name)
                     # Now add the source to our used sources
                     self._apt_sources[src_name] = source
                     # add the name for easy future lookup
@@ -457,22 +1307,54 @@ class DebTracer(DistributionTracer):
         return ver_dict
 
     def _get_date_from_release_file(self, archive_uri, uri_suite):
-        date = None
+        spec = self._get_release_spec(archive_uri, uri_suite)
+        if not (spec and spec.date):
+            return None
+        return str(pytz.utc.localize(
+            datetime.utcfromtimestamp(
+                mktime_tz(parsedate_tz(spec.date)))))
+
+    def _get_release_spec(self, archive_uri, uri_suite):
+        """Return spec of the first available Release file of the source"""
         for filename in get_apt_release_file_names(
                 archive_uri,
                 uri_suite):
+            if filename not in self._release_specs:
+                header = self._read_release_file_header(filename)
+                self._release_specs[filename] = \
+                    get_spec_from_release_file(header) \
+                    if header is not None else None
+            if self._release_specs[filename]:
+                return self._release_specs[filename]
+        return None
+
+    def _read_release_file_header(self, filename):
+        """Return header of the Release file or None if it is not available
+
+        Only complete lines of the first _RELEASE_HEADER_SIZE bytes are
+        returned.
+        """
+        # NOTE: We will be trying release files that end in "InRelease" and
+        # "Release", so we expect to fail in opening specific attempts.
+        if self._is_local_session():
             try:
-                out = self._session.read(filename)
-                spec = get_spec_from_release_file(out)
-                date = str(pytz.utc.localize(
-                    datetime.utcfromtimestamp(
-                        mktime_tz(parsedate_tz(spec.date)))))
-            except CommandError as _:
-                # NOTE: We will be trying release files that end in
-                # "Release" and "InRelease", so we expect to fail in opening
-                # specific attempts.
-                pass
-        return date
+                with open(filename, 'rb') as f:
+                    out = f.read(_RELEASE_HEADER_SIZE)
+            except (IOError, OSError):
+                return None
+        else:
+            try:
+                out, _ = self._session.execute_command(
+                    ['head', '-c', str(_RELEASE_HEADER_SIZE), filename]
+                )
+            except CommandError:
+                return None
+        out = utils.to_binarystring(out, "utf-8")
+        if len(out) >= _RELEASE_HEADER_SIZE:
+            # the last line (possibly within a multibyte character) might be
+            # cut, so cut it before decoding
+            out = out[:out.rfind(b'\n') + 1]
+        return out.decode("utf-8", "replace")
 
     def _run_dpkg_query(self, subfiles):
         try:
@@ -491,10 +1373,19 @@ class DebTracer(DistributionTracer):
         out = utils.to_unicode(out, "utf-8")
         return out
 
+    @staticmethod
+    def _is_diversion_line(line):
+        """Return True if dpkg-query -S line describes a diversion
+
+        Those are "diversion by PACKAGE from/to: PATH" and, for diversions
+        by the local admin, "local diversion from/to: PATH".
+        """
+        return line.startswith(('diversion by ', 'local diversion '))
+
     @staticmethod
     def _parse_dpkgquery_line(line):
-        if line.startswith('diversion '):
-            return None  # we are ignoring diversion details ATM  TODO
+        if DebTracer._is_diversion_line(line):
+            return None  # diversions are resolved from the diversions table
         if ',' in line:
             lgr.warning("dpkg-query line has multiple packages (%s)" % line)
         res = _DPKG_QUERY_PARSER.match(line)
@@ -7,6 +7,7 @@
 #
 # ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 import collections
+import mock
 import os
 import pytest
 
@@ -17,12 +18,15 @@ from unittest import SkipTest
 
 import yaml
 import attr
+from niceman import cfg
 from niceman.formats.niceman import NicemanProvenance
 from niceman.tests.utils import skip_if_no_network, assert_is_subset_recur
+from niceman.tests.utils import with_tempfile
 
 import json
 
 from niceman.distributions.conda import CondaTracer
+from niceman.support.exceptions import CommandError
 
 
 @pytest.fixture(scope="session")
@@ -96,3 +100,334 @@ def test_parse_conda_export_pip_package_entry():
     assert CondaTracer.parse_pip_package_entry(
         "niceman (/test/repronim)==0.0.2") == (
            "niceman", "/test/repronim")
+
+
+_CONDA_META = [
+    {"name": "xz", "version": "5.2.3", "build": "0",
+     "files": ["bin/xz", "lib/liblzma.so"]},
+    {"name": "zlib", "version": "1.2.11", "build": "0",
+     "files": ["lib/libz.so"]},
+]
+
+
+def _check_conda_package_details(tracer, conda_path):
+    packages, file_to_package = tracer._get_conda_package_details(conda_path)
+    assert sorted(packages) == ["xz=5.2.3=0", "zlib=1.2.11=0"]
+    assert file_to_package == {
+        os.path.join(conda_path, "bin/xz"): "xz=5.2.3=0",
+        os.path.join(conda_path, "lib/liblzma.so"): "xz=5.2.3=0",
+        os.path.join(conda_path, "lib/libz.so"): "zlib=1.2.11=0",
+    }
+
+
+@with_tempfile(mkdir=True)
+def test_get_conda_package_details_local(conda_path=None):
+    os.mkdir(os.path.join(conda_path, "conda-meta"))
+    for details in _CONDA_META:
+        # UTF-8 regardless of the locale
+        details = dict(details, license=u"\u00a9 authors")
+        with open(os.path.join(conda_path, "conda-meta",
+                               details["name"] + ".json"), "wb") as f:
+            f.write(json.dumps(details, indent=2, ensure_ascii=False)
+                    .encode("utf-8"))
+    # not a package
+    with open(os.path.join(conda_path, "conda-meta", "history"), "w") as f:
+        f.write("==> 2017-10-10 <==\n")
+    _check_conda_package_details(CondaTracer(), conda_path)
+
+
+def test_get_conda_package_details_remote():
+    session = mock.MagicMock()
+    # a single command for all the files
+    session.execute_command.return_value = (
+        "\n".join(json.dumps(d, indent=2) for d in _CONDA_META) + "\n", "")
+    _check_conda_package_details(CondaTracer(session=session), "/conda")
+    session.execute_command.assert_called_once_with(
+        ['find', '/conda/conda-meta', '-maxdepth', '1', '-name', '*.json',
+         '-exec', 'cat', '{}', '+'])
+    # sorted by the file names regardless of the order find lists them in
+    session.execute_command.return_value = (
+        "".join(json.dumps(d) for d in _CONDA_META[::-1]), "")
+    assert [d["name"] for d in
+            CondaTracer(session=session)._iter_conda_meta("/conda")] == \
+        ["xz", "zlib"]
+
+
+@with_tempfile(mkdir=True)
+def test_get_conda_info_memoized(cache_dir=None):
+    calls = []
+    mtime = ["1507651200"]
+    site_packages_mtime = ["1507651200.5"]
+
+    def execute_command(cmd):
+        calls.append(cmd)
+        if cmd[0] == 'stat':
+            return mtime[0] + "\n", ""
+        if cmd[0] == 'find':
+            return "/conda/lib/python2.7/site-packages %s\n" \
+                % site_packages_mtime[0], ""
+        if 'info' in cmd:
+            return json.dumps({"root_prefix": "/conda",
+                               "conda_version": "4.3.27"}), ""
+        return "name: root\ndependencies:\n- python=2.7.14=0\n", ""
+
+    def get_tracer():
+        session = mock.MagicMock()
+        session.execute_command.side_effect = execute_command
+        return CondaTracer(session=session)
+
+    def conda_calls():
+        return [c for c in calls if c[0] not in ('stat', 'find')]
+
+    with mock.patch.object(cfg, 'getpath', return_value=cache_dir):
+        tracer = get_tracer()
+        for _ in range(2):
+            assert tracer._get_conda_info("/conda")["root_prefix"] == "/conda"
+            assert tracer._get_conda_env_export("/conda", "/conda") == \
+                {"name": "root", "dependencies": ["python=2.7.14=0"]}
+        assert len(conda_calls()) == 2
+        # stored on disk (without leftovers of writing it), so a new tracer
+        # does not need to run conda
+        assert sorted(f[-5:] for f in os.listdir(cache_dir)) == ['.json'] * 2
+        assert tracer._get_conda_info("/conda") == \
+            get_tracer()._get_conda_info("/conda")
+        assert len(conda_calls()) == 2
+        # but it does as soon as the environment gets changed
+        mtime[0] = "1507651300"
+        get_tracer()._get_conda_info("/conda")
+        assert len(conda_calls()) == 3
+        get_tracer()._get_conda_env_export("/conda", "/conda")
+        assert len(conda_calls()) == 4
+        # pip does not touch the history, so export gets rerun upon changes
+        # in site-packages, while info stays cached
+        site_packages_mtime[0] = "1507651400.5"
+        tracer = get_tracer()
+        tracer._get_conda_info("/conda")
+        assert len(conda_calls()) == 4
+        tracer._get_conda_env_export("/conda", "/conda")
+        assert len(conda_calls()) == 5
+        assert calls[-2] == [
+            'find', '/conda/lib', '-mindepth', '2', '-maxdepth', '2',
+            '-name', 'site-packages', '-printf', '%p %T@\\n']
+
+
+
+@with_tempfile(mkdir=True)
+def test_get_site_packages_mtime_local(conda_path=None):
+    tracer = CondaTracer()
+    assert tracer._get_site_packages_mtime(conda_path) == ''
+    site_packages = os.path.join(conda_path, "lib", "python2.7",
+                                 "site-packages")
+    os.makedirs(site_packages)
+    os.utime(site_packages, (1507651200, 1507651200))
+    mtime = tracer._get_site_packages_mtime(conda_path)
+    assert mtime
+    os.mkdir(os.path.join(site_packages, "rpaths-0.13.dist-info"))
+    os.utime(site_packages, (1507651300, 1507651300))
+    assert tracer._get_site_packages_mtime(conda_path) != mtime
+
+_PIP_METADATA = {
+    "lib/python2.7/site-packages/rpaths-0.13.dist-info/METADATA": """\
+Metadata-Version: 2.0
+Name: rpaths
+Version: 0.13
+Summary: Read-only path manipulation library
+  which spans lines
+
+Name: not a header
+""",
+    "lib/python2.7/site-packages/rpaths-0.13.dist-info/RECORD": """\
+rpaths.py,sha256=abc,12345
+"odd,name.py",sha256=def,10
+rpaths-0.13.dist-info/RECORD,,
+../../../bin/rpaths,sha256=ghi,100
+""",
+    "lib/python2.7/site-packages/Foo_Bar-1.0-py2.7.egg-info/PKG-INFO": """\
+Metadata-Version: 1.0
+Name: Foo_Bar
+Version: 1.0
+""",
+    "lib/python2.7/site-packages/Foo_Bar-1.0-py2.7.egg-info/"
+    "installed-files.txt": """\
+../foobar/__init__.py
+./
+PKG-INFO
+""",
+}
+
+
+def _check_pip_package_details(tracer, conda_path):
+    export = {"dependencies": [
+        "python=2.7.14=0",
+        {"pip": ["rpaths==0.13", "foo-bar==1.0"]}]}
+    packages, file_to_package = tracer._get_conda_pip_package_details(
+        export, conda_path)
+    assert packages == {
+        "rpaths==0.13": {"name": "rpaths", "version": "0.13",
+                         "installer": "pip", "origin_location": None},
+        "foo-bar==1.0": {"name": "Foo_Bar", "version": "1.0",
+                         "installer": "pip", "origin_location": None},
+    }
+    site_packages = os.path.join(conda_path, "lib/python2.7/site-packages")
+    egg_info = os.path.join(site_packages, "Foo_Bar-1.0-py2.7.egg-info")
+    assert file_to_package == {
+        os.path.join(site_packages, "rpaths.py"): "rpaths==0.13",
+        os.path.join(site_packages, "odd,name.py"): "rpaths==0.13",
+        os.path.join(site_packages, "rpaths-0.13.dist-info/RECORD"):
+            "rpaths==0.13",
+        os.path.join(conda_path, "bin/rpaths"): "rpaths==0.13",
+        os.path.join(site_packages, "foobar/__init__.py"): "foo-bar==1.0",
+        egg_info: "foo-bar==1.0",
+        os.path.join(egg_info, "PKG-INFO"): "foo-bar==1.0",
+    }
+
+
+@with_tempfile(mkdir=True)
+def test_get_conda_pip_package_details_local(conda_path=None):
+    for path, content in _PIP_METADATA.items():
+        path = os.path.join(conda_path, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(content)
+    _check_pip_package_details(CondaTracer(), conda_path)
+
+
+def test_get_conda_pip_package_details_remote():
+    session = mock.MagicMock()
+    session.execute_command.return_value = ("".join(
+        "\0/conda/%s\0%s" % item for item in _PIP_METADATA.items()), "")
+    _check_pip_package_details(CondaTracer(session=session), "/conda")
+    # all metadata were read at once, and pip was not needed
+    assert session.execute_command.call_count == 1
+    assert session.execute_command.call_args[0][0][:2] == \
+        ['find', '/conda/lib']
+
+
+def test_get_conda_pip_package_details_pip_show():
+    session = mock.MagicMock()
+    session.execute_command.side_effect = [
+        ("", ""),
+        ("""\
+Name: niceman
+Version: 0.0.2
+Location: /test/repronim
+Files:
+  niceman/__init__.py
+""", "")]
+    export = {"dependencies": [{"pip": ["niceman (/test/repronim)==0.0.2"]}]}
+    packages, file_to_package = CondaTracer(
+        session=session)._get_conda_pip_package_details(export, "/conda")
+    assert packages["niceman (/test/repronim)==0.0.2"] == {
+        "name": "niceman", "version": "0.0.2", "installer": "pip",
+        "origin_location": "/test/repronim"}
+    assert file_to_package == {
+        "/test/repronim/niceman/__init__.py":
+            "niceman (/test/repronim)==0.0.2"}
+    session.execute_command.assert_called_with(
+        "/conda/bin/pip show -f niceman")
+
+
+def test_get_conda_path():
+    session = mock.MagicMock()
+    session.execute_command.side_effect = CommandError(
+        cmd="ls", stdout="""\
+/conda/bin/conda
+/conda/conda-meta
+/conda/envs/py2/bin/conda
+/conda/envs/py2/conda-meta
+/home/user/bin/conda
+""")
+    tracer = CondaTracer(session=session)
+    tracer._probe_conda_paths(["/conda/bin/sqlite3",
+                               "/conda/envs/py2/bin/xz",
+                               "/home/user/bin/python"])
+    # all the directories are probed at once
+    cmd = session.execute_command.call_args[0][0]
+    assert cmd[:2] == ['ls', '-1d']
+    assert sorted(cmd[2:]) == sorted(
+        os.path.join(d, f)
+        for d in ["/conda", "/conda/bin", "/conda/envs", "/conda/envs/py2",
+                  "/conda/envs/py2/bin", "/home", "/home/user",
+                  "/home/user/bin",
+                  # paths themselves could be environments
+                  "/conda/bin/sqlite3", "/conda/envs/py2/bin/xz",
+                  "/home/user/bin/python"]
+        for f in ['bin/conda', 'conda-meta'])
+    assert tracer._get_conda_path("/conda/bin/sqlite3") == "/conda"
+    assert tracer._get_conda_path("/conda/envs/py2/bin/xz") == \
+        "/conda/envs/py2"
+    assert tracer._get_conda_path("/home/user/bin/python") is None
+    assert tracer._get_conda_path("/conda/envs/py2") == "/conda/envs/py2"
+    assert session.execute_command.call_count == 1
+
+
+def _make_conda_env(path, meta):
+    for d in ("bin", "conda-meta"):
+        os.makedirs(os.path.join(path, d))
+    with open(os.path.join(path, "bin", "conda"), "w"):
+        pass
+    for details in meta:
+        with open(os.path.join(path, "conda-meta",
+                               details["name"] + ".json"), "w") as f:
+            json.dump(details, f)
+
+
+@with_tempfile(mkdir=True)
+def test_identify_distributions_routing(root=None):
+    env = os.path.join(root, "envs", "py2")
+    _make_conda_env(root, [_CONDA_META[0]])
+    _make_conda_env(env, _CONDA_META)
+    files = [os.path.join(env, "lib/libz.so"),
+             os.path.join(root, "bin/xz"),
+             os.path.join(env, "bin/xz"),
+             "/sbin/iptables"]
+    tracer = CondaTracer()
+    with mock.patch.object(tracer, "_get_conda_info",
+                           return_value={"root_prefix": root}), \
+            mock.patch.object(tracer, "_get_conda_env_export",
+                              return_value={"dependencies": []}), \
+            mock.patch.object(tracer, "_get_conda_package_details",
+                              wraps=tracer._get_conda_package_details) \
+            as get_details, \
+            mock.patch.object(tracer, "_get_conda_pip_package_details",
+                              return_value=({}, {})) as get_pip_details:
+        (dist, unknown_files), = tracer.identify_distributions(files)
+    assert unknown_files == ["/sbin/iptables"]
+    envs = {e.path: {p.name: p.files for p in e.packages}
+            for e in dist.environments}
+    assert envs == {root: {"xz": ["bin/xz"]},
+                    env: {"xz": ["bin/xz"], "zlib": ["lib/libz.so"]}}
+    # only the files routed to the environment are considered for conda
+    # packages, and those routed to none only for pip ones
+    env_files = [os.path.join(env, "bin/xz"), os.path.join(env, "lib/libz.so")]
+    root_files = [os.path.join(root, "bin/xz")]
+    assert {frozenset(c[0][1]) for c in get_details.call_args_list} == \
+        {frozenset(env_files), frozenset(root_files)}
+    assert {frozenset(c[0][2]) for c in get_pip_details.call_args_list} == {
+        frozenset(env_files + ["/sbin/iptables"]),
+        frozenset(root_files + ["/sbin/iptables"]),
+    }
+
+
+@with_tempfile(mkdir=True)
+def test_identify_distributions_jobs(root=None):
+    envs = [os.path.join(root, "envs", "py%d" % i) for i in range(4)]
+    _make_conda_env(root, [_CONDA_META[0]])
+    for env in envs:
+        _make_conda_env(env, _CONDA_META)
+    files = [os.path.join(env, "lib/libz.so") for env in envs] + \
+        [os.path.join(root, "bin/xz")]
+    results = []
+    for jobs, files_ in ((1, files), (4, files[::-1])):
+        tracer = CondaTracer(jobs=jobs)
+        with mock.patch.object(tracer, "_get_conda_info",
+                               return_value={"root_prefix": root}), \
+                mock.patch.object(tracer, "_get_conda_env_export",
+                                  return_value={"dependencies": []}):
+            (dist, unknown_files), = tracer.identify_distributions(files_)
+        assert not unknown_files
+        results.append(attr.asdict(dist))
+    assert results[0] == results[1]
+    assert [(e["name"], e["path"]) for e in results[0]["environments"]] == \
+        [("conda_env-%d" % i, path) for i, path in enumerate([root] + envs)]
@@ -7,10 +7,17 @@
 #
 # ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 
+import copy
+import hashlib
+import logging
 import os
+import threading
+import time
 
 from pprint import pprint
 
+from niceman import cfg
+from niceman.distributions.debian import APTSource
 from niceman.distributions.debian import DebTracer
 from niceman.distributions.debian import DEBPackage
 from niceman.distributions.debian import DebianDistribution
@@ -18,8 +25,14 @@ from niceman.distributions.debian import DebianDistribution
 import pytest
 
 import mock
+import attr
 
 from niceman.tests.utils import skip_if_no_apt_cache
+from niceman.tests.utils import with_tempfile
+from niceman.tests.utils import assert_in
+from niceman.utils import swallow_logs
+from niceman.support.exceptions import CommandError
+from niceman.support.exceptions import SessionRuntimeError
 
 
 @skip_if_no_apt_cache
@@ -106,10 +119,14 @@ def test_parse_dpkgquery_line():
            {'name': 'fsl-5.0-eddy-nonfree', 'path': '/usr/lib/fsl/5.0'}
 
     assert parse('diversion by dash from: /bin/sh') is None
+    assert parse('local diversion to: /etc/foo.orig') is None
 
 
 def test_get_packagefields_for_files():
     manager = DebTracer()
+    manager._dpkg_index = False  # so dpkg-query is used
+    manager._dir_aliases = {}  # not a merged-/usr system
+    manager._diversions = {}
     # TODO: mock! and bring back afni and fail2ban
     files = ['/bin/sh',  # the tricky one with alternatives etc, on my system - provided by dash
              '/lib/i386-linux-gnu/libz.so.1.2.8', '/lib/x86_64-linux-gnu/libz.so.1.2.8',  # multiarch
@@ -141,6 +158,545 @@ fail2ban: /usr/bin/fail2ban-server
         '/bin/sh': {'name': u'dash'}
     }
 
+def test_get_packagefields_for_files_from_dpkg_index():
+    manager = DebTracer()
+    manager._cache_path = False
+    manager._dir_aliases = {}
+    manager._diversions = {}
+    files = ['/bin/sh',
+             '/lib/i386-linux-gnu/libz.so.1.2.8', '/lib/x86_64-linux-gnu/libz.so.1.2.8',
+             '/usr/lib/afni/bin/afni',
+             '/usr/bin/fail2ban-server', '/usr/bin/fail2ban-server',
+             '/usr/bin/removed',
+             '/bogus'
+             ]
+
+    def read(path):
+        assert path == '/var/lib/dpkg/status'
+        return """\
+Package: dash
+Status: install ok installed
+Architecture: amd64
+Version: 0.5.8-2.3
+
+Package: zlib1g
+Status: install ok installed
+Multi-Arch: same
+Architecture: i386
+Version: 1:1.2.8.dfsg-5
+
+Package: zlib1g
+Status: install ok installed
+Multi-Arch: same
+Architecture: amd64
+Version: 1:1.2.8.dfsg-5
+
+Package: afni
+Status: install ok installed
+Multi-Arch: same
+Architecture: amd64
+Version: 16.2.07~dfsg.1-2~nd90+1
+
+Package: fail2ban
+Status: install ok installed
+Architecture: all
+Version: 0.9.6-2
+
+Package: removed
+Status: purge ok not-installed
+Architecture: amd64
+Version: 1.0-1
+"""
+
+    def execute_command(cmd):
+        assert cmd[0] == 'find'
+        return """\
+\t/var/lib/dpkg/info/dash.list
+/.
+/bin
+/bin/sh
+\t/var/lib/dpkg/info/zlib1g:i386.list
+/.
+/lib/i386-linux-gnu/libz.so.1.2.8
+\t/var/lib/dpkg/info/zlib1g:amd64.list
+/lib/x86_64-linux-gnu/libz.so.1.2.8
+\t/var/lib/dpkg/info/afni.list
+/usr/lib/afni/bin/afni
+\t/var/lib/dpkg/info/fail2ban.list
+/usr/bin/fail2ban-server
+\t/var/lib/dpkg/info/removed.list
+/usr/bin/removed
+""", ""
+
+    with mock.patch.object(manager._session, "read", read), \
+            mock.patch.object(manager._session, "execute_command",
+                              execute_command):
+        out = manager._get_packagefields_for_files(files)
+
+    # the same as we get from dpkg-query
+    assert out == {
+        '/lib/i386-linux-gnu/libz.so.1.2.8': {'name': u'zlib1g', 'architecture': u'i386'},
+        '/lib/x86_64-linux-gnu/libz.so.1.2.8': {'name': u'zlib1g', 'architecture': u'amd64'},
+        '/usr/bin/fail2ban-server': {'name': u'fail2ban'},
+        '/usr/lib/afni/bin/afni': {'name': u'afni', 'architecture': u'amd64'},
+        '/bin/sh': {'name': u'dash'}
+    }
+
+
+def test_get_packagefields_for_files_usrmerge():
+    manager = DebTracer()
+    manager._diversions = {}
+
+    def execute_command(cmd):
+        assert cmd[:2] == ['find', '/']
+        return "/bin\tusr/bin\n/lib64\t/usr/lib64\n/lib32\t/lib\n", ""
+
+    with mock.patch.object(manager._session, "execute_command",
+                           execute_command):
+        assert manager._get_path_aliases('/bin/bash') == ['/usr/bin/bash']
+        assert manager._get_path_aliases('/usr/bin/bash') == ['/bin/bash']
+        assert manager._get_path_aliases('/usr/lib64/ld.so') == \
+            ['/lib64/ld.so']
+        assert manager._get_path_aliases('/usr/bin') == []
+        assert manager._get_path_aliases('/lib32/libc.so') == []
+        assert manager._get_path_aliases('/binary/bash') == []
+
+    files = ['/bin/bash', '/usr/bin/sh', '/bin/sh', '/usr/bin/bogus']
+    manager._dpkg_index = {
+        '/bin/bash': [{'name': 'bash'}],
+        '/usr/bin/bash': [{'name': 'bash-usr'}],
+        '/bin/sh': [{'name': 'dash'}],
+    }
+    expected = {
+        '/bin/bash': {'name': 'bash'},
+        '/usr/bin/sh': {'name': 'dash'},
+        '/bin/sh': {'name': 'dash'},
+    }
+    assert manager._get_packagefields_for_files(files) == expected
+
+    # and the same via dpkg-query
+    manager._dpkg_index = False
+
+    def _run_dpkg_query(subfiles):
+        assert subfiles == files + ['/bin/bogus', '/usr/bin/bash']
+        return """\
+bash: /bin/bash
+dash: /bin/sh
+bash-usr: /usr/bin/bash
+"""
+    with mock.patch.object(manager, "_run_dpkg_query", _run_dpkg_query):
+        assert manager._get_packagefields_for_files(files) == expected
+
+
+def test_get_packagefields_for_files_dpkg_index_fallback():
+    manager = DebTracer()
+    manager._cache_path = False
+    manager._dir_aliases = {}
+    manager._diversions = {}
+    files = ['/bin/sh', '/bogus']
+
+    def read(path):
+        # e.g. some warning was printed to stderr
+        raise SessionRuntimeError("Running had std error output: warning")
+
+    def _run_dpkg_query(subfiles):
+        assert subfiles == files
+        return "dash: /bin/sh\n"
+
+    with mock.patch.object(manager._session, "read", read), \
+            mock.patch.object(manager, "_run_dpkg_query", _run_dpkg_query):
+        assert manager._get_packagefields_for_files(files) == \
+            {'/bin/sh': {'name': 'dash'}}
+    assert manager._dpkg_index is False
+
+
+def test_get_packagefields_for_files_diverted():
+    manager = DebTracer()
+    manager._cache_path = False
+    manager._dir_aliases = {}
+    # /etc/foo is diverted locally, but no package ships it
+    files = ['/bin/sh', '/bin/sh.distrib', '/usr/bin/vi', '/usr/bin/vi.orig',
+             '/usr/bin/dash', '/etc/foo.orig']
+
+    def read(path):
+        if path == '/var/lib/dpkg/diversions':
+            return """\
+/bin/sh
+/bin/sh.distrib
+dash
+/usr/bin/vi
+/usr/bin/vi.orig
+:
+/etc/foo
+/etc/foo.orig
+:
+"""
+        assert path == '/var/lib/dpkg/status'
+        return """\
+Package: dash
+Status: install ok installed
+Architecture: amd64
+Version: 0.5.8-2.3
+
+Package: bash
+Status: install ok installed
+Architecture: amd64
+Version: 4.4-5
+
+Package: vim
+Status: install ok installed
+Architecture: amd64
+Version: 2:8.0.0197-4
+"""
+
+    def execute_command(cmd):
+        assert cmd[0] == 'find'
+        return """\
+\t/var/lib/dpkg/info/dash.list
+/bin/sh
+/usr/bin/dash
+\t/var/lib/dpkg/info/bash.list
+/bin/sh
+\t/var/lib/dpkg/info/vim.list
+/usr/bin/vi
+""", ""
+
+    expected = {
+        '/bin/sh': {'name': 'dash'},
+        '/bin/sh.distrib': {'name': 'bash'},
+        '/usr/bin/dash': {'name': 'dash'},
+        '/usr/bin/vi.orig': {'name': 'vim'},
+    }
+    with mock.patch.object(manager._session, "read", read), \
+            mock.patch.object(manager._session, "execute_command",
+                              execute_command):
+        assert manager._get_packagefields_for_files(files) == expected
+
+    # and the same via dpkg-query
+    manager._dpkg_index = False
+
+    def _run_dpkg_query(subfiles):
+        # original paths are queried for diverted ones
+        assert subfiles == ['/usr/bin/dash', '/bin/sh', '/etc/foo',
+                            '/usr/bin/vi']
+        return """\
+dash: /usr/bin/dash
+diversion by dash from: /bin/sh
+diversion by dash to: /bin/sh.distrib
+bash, dash: /bin/sh
+local diversion from: /etc/foo
+local diversion to: /etc/foo.orig
+local diversion from: /usr/bin/vi
+local diversion to: /usr/bin/vi.orig
+vim: /usr/bin/vi
+"""
+    with mock.patch.object(manager, "_run_dpkg_query", _run_dpkg_query):
+        assert manager._get_packagefields_for_files(files) == expected
+
+
+def test_get_packagefields_for_files_jobs():
+    manager = DebTracer(jobs=4)
+    manager._dpkg_index = False
+    manager._dir_aliases = {}
+    manager._diversions = {}
+    files = ['/usr/bin/f%02d' % i for i in range(20)]
+    threads = set()
+
+    def _run_dpkg_query(subfiles):
+        assert len(subfiles) == 2
+        threads.add(threading.current_thread().name)
+        time.sleep(0.01)
+        return ''.join('p%s: %s\n' % (f[-2:], f) for f in subfiles)
+
+    with mock.patch.object(manager, "_run_dpkg_query", _run_dpkg_query), \
+            mock.patch('niceman.distributions.base._MAX_LEN_CMDLINE',
+                       len('dpkg-query -S') + 2 * (len(files[0]) + 1)):
+        out = manager._get_packagefields_for_files(files)
+    assert out == {f: {'name': 'p' + f[-2:]} for f in files}
+    assert len(threads) > 1
+
+    # failures are propagated
+    def _run_dpkg_query(subfiles):
+        raise CommandError(cmd='dpkg-query', msg="failed")
+
+    with mock.patch.object(manager, "_run_dpkg_query", _run_dpkg_query):
+        with pytest.raises(CommandError):
+            manager._get_packagefields_for_files(files)
+
+
+def test_prefetch_packages():
+    tracer = DebTracer()
+    calls = []
+
+    def execute_command(cmd):
+        calls.append(cmd[:2])
+        if cmd[:2] == ['dpkg', '-s']:
+            # unique ones, in the order of name and architecture
+            assert cmd[2:] == ['afni', 'bogus', 'zlib1g:amd64', 'zlib1g:i386']
+            return """\
+Package: zlib1g
+Status: install ok installed
+Architecture: i386
+Version: 1:1.2.8.dfsg-5
+
+Package: zlib1g
+Status: install ok installed
+Architecture: amd64
+Version: 1:1.2.8.dfsg-5
+
+Package: afni
+Status: install ok installed
+Architecture: amd64
+Version: 16.2.07~dfsg.1-2~nd90+1
+""", ""
+        elif cmd[:2] == ['apt-cache', 'show']:
+            assert cmd[2:] == ['afni:amd64=16.2.07~dfsg.1-2~nd90+1',
+                               'zlib1g:amd64=1:1.2.8.dfsg-5',
+                               'zlib1g:i386=1:1.2.8.dfsg-5']
+            return """\
+Package: zlib1g
+Architecture: amd64
+Version: 1:1.2.8.dfsg-5
+Source: zlib
+Size: 51002
+
+Package: afni
+Architecture: amd64
+Version: 16.2.07~dfsg.1-2~nd90+1
+Size: 1000
+""", ""
+        elif cmd[:2] == ['find', '/var/lib/apt/lists']:
+            return "", ""  # no APT Packages indexes
+        elif cmd[:2] == ['apt-cache', 'policy']:
+            # the same package of different architectures is queried
+            # separately
+            assert cmd[2:] in (['afni:amd64', 'zlib1g:amd64'],
+                               ['zlib1g:amd64', 'afni:amd64'],
+                               ['zlib1g:i386'])
+            return ''.join("""\
+%s:
+  Installed: 1:1.2.8.dfsg-5
+  Candidate: 1:1.2.8.dfsg-5
+  Version table:
+ *** 1:1.2.8.dfsg-5 100
+        100 /var/lib/dpkg/status
+""" % q.replace(':amd64', '') for q in cmd[2:]), ""
+        raise AssertionError("Unexpected command %s" % cmd)
+
+    with mock.patch.object(tracer._session, "execute_command",
+                           execute_command):
+        tracer._install_dates = {}
+        tracer._prefetch_packages([
+            {'name': 'zlib1g', 'architecture': 'i386'},
+            {'name': 'zlib1g', 'architecture': 'amd64'},
+            {'name': 'afni'},
+            {'name': 'bogus'},
+            {'architecture': 'i386', 'name': 'zlib1g'},
+        ])
+        # Nothing else should be called while querying individual packages
+        calls_before = len(calls)
+        assert tracer._get_pkg_arch_and_version('afni', None) == \
+            ('amd64', '16.2.07~dfsg.1-2~nd90+1')
+        assert tracer._get_pkg_arch_and_version('bogus', None) == \
+            (None, None)
+        assert tracer._get_pkg_details(
+            'zlib1g', 'amd64', '1:1.2.8.dfsg-5')['Source_name'] == 'zlib'
+        assert tracer._get_pkg_details(
+            'zlib1g', 'i386', '1:1.2.8.dfsg-5') is None
+        assert tracer._get_pkg_versions_and_sources('afni', 'amd64') == \
+            {'1:1.2.8.dfsg-5': []}
+        assert len(calls) == calls_before
+    assert calls.count(['apt-cache', 'policy']) == 2
+
+
+@with_tempfile(content="""\
+Package: afni
+Architecture: amd64
+Version: 16.2.07~dfsg.1-2~nd90+1
+Description: toolkit for analyzing and visualizing functional MRI data
+ AFNI is a set of C programs for processing, analyzing, and displaying
+ functional MRI (FMRI) data.
+Size: 1000
+MD5sum: e53379fd0d60e0af6304af78aa8ef2b7
+
+Package: zlib1g
+Source: zlib
+Architecture: amd64
+Version: 1:1.2.8.dfsg-5
+Size: 51002
+
+Package: zlib1g
+Source: zlib
+Architecture: amd64
+Version: 1:1.2.8.dfsg-2
+Size: 51000
+""")
+def test_get_pkgs_details_from_apt_lists(index_path=None):
+    tracer = DebTracer()
+    with mock.patch.object(tracer, "_get_apt_packages_indexes",
+                           lambda: [index_path]):
+        details = tracer._get_pkgs_details_from_apt_lists({'afni', 'zlib1g'})
+        assert sorted(details) == ['afni:amd64=16.2.07~dfsg.1-2~nd90+1',
+                                   'zlib1g:amd64=1:1.2.8.dfsg-2',
+                                   'zlib1g:amd64=1:1.2.8.dfsg-5']
+        assert details['afni:amd64=16.2.07~dfsg.1-2~nd90+1']['MD5sum'] == \
+            'e53379fd0d60e0af6304af78aa8ef2b7'
+        assert details['zlib1g:amd64=1:1.2.8.dfsg-5']['Source_name'] == 'zlib'
+
+        assert list(tracer._get_pkgs_details_from_apt_lists({'afni'})) == \
+            ['afni:amd64=16.2.07~dfsg.1-2~nd90+1']
+
+
+def test_get_pkg_install_date():
+    tracer = DebTracer()
+    calls = []
+
+    def execute_command(cmd):
+        calls.append(cmd)
+        assert cmd[:2] == ['find', '/var/lib/dpkg/info']
+        return """\
+1473254442.7165498110 afni.list
+1473254443.0000000000 zlib1g:amd64.list
+1473254444.0000000000 zlib1g:i386.list
+""", ""
+
+    with mock.patch.object(tracer._session, "execute_command",
+                           execute_command):
+        assert tracer._get_pkg_install_date('afni') == \
+            '2016-09-07 13:20:42+00:00'
+        assert tracer._get_pkg_install_date('afni', 'amd64') == \
+            '2016-09-07 13:20:42+00:00'
+        assert tracer._get_pkg_install_date('zlib1g', 'i386') == \
+            '2016-09-07 13:20:44+00:00'
+        assert tracer._get_pkg_install_date('bogus') is None
+    assert len(calls) == 1
+
+
+def test_get_date_from_release_file():
+    tracer = DebTracer()
+    lists = '/var/lib/apt/lists/deb.debian.org_debian_dists_stretch_'
+    headers = {
+        lists + 'InRelease': """\
+-----BEGIN PGP SIGNED MESSAGE-----
+Hash: SHA256
+
+Origin: Debian
+Suite: stable
+Date: Sat, 14 Oct 2017 10:17:35 UTC
+""",
+        lists + 'Release': "Origin: Debian\nDate: bogus\n",
+    }
+    read = []
+
+    def read_release_file_header(filename):
+        read.append(filename)
+        return headers.get(filename)
+
+    with mock.patch.object(tracer, "_read_release_file_header",
+                           read_release_file_header):
+        for _ in range(2):
+            assert tracer._get_date_from_release_file(
+                'http://deb.debian.org/debian', 'stretch') == \
+                '2017-10-14 10:17:35+00:00'
+        assert tracer._get_date_from_release_file(
+            'http://deb.debian.org/debian', 'sid') is None
+    # Release is not probed once InRelease is found, and each file is
+    # read only once
+    assert read == [lists + 'InRelease',
+                    '/var/lib/apt/lists/deb.debian.org_debian_dists_sid_InRelease',
+                    '/var/lib/apt/lists/deb.debian.org_debian_dists_sid_Release']
+
+
+@with_tempfile(content="Origin: Debian\n" + "X-Long: %s\n" % ("x" * 5000))
+def test_read_release_file_header(path=None):
+    tracer = DebTracer()
+    assert tracer._read_release_file_header(path) == "Origin: Debian\n"
+    assert tracer._read_release_file_header(path + '_bogus') is None
+
+
+# the header limit cuts within the multibyte character
+@with_tempfile(content=u"Origin: Debian\nLabel: %s\u00e9\n" % ("x" * 4073))
+def test_read_release_file_header_multibyte(path=None):
+    tracer = DebTracer()
+    assert tracer._read_release_file_header(path) == "Origin: Debian\n"
+    # a session might have decoded the cut character already
+    with open(path, 'rb') as f:
+        out = f.read(4096).decode('utf-8', 'replace')
+    with mock.patch.object(tracer, '_is_local_session', return_value=False), \
+            mock.patch.object(tracer._session, 'execute_command',
+                              return_value=(out, '')):
+        assert tracer._read_release_file_header(path) == "Origin: Debian\n"
+
+
+@with_tempfile(mkdir=True)
+def test_cache(cache_dir=None):
+    state = ["/var/lib/dpkg/status 100 1473254442\n"]
+    loaded = []
+
+    def execute_command(cmd):
+        assert cmd[0] == 'stat'
+        return state[0], ""
+
+    def load_dpkg_index(self):
+        loaded.append(True)
+        return {'/bin/sh': [{'name': 'dash'}],
+                '/lib/x86_64-linux-gnu/libz.so.1': [
+                    {'name': 'zlib1g', 'architecture': 'amd64'}]}
+
+    def get_index():
+        tracer = DebTracer()
+        with mock.patch.object(tracer._session, "execute_command",
+                               execute_command):
+            index = tracer._get_dpkg_index()
+            # the cache is kept in memory until saved
+            tracer._store_in_cache('other', {})
+            assert tracer._load_from_cache('other') == {}
+            tracer._save_cache()
+            return index
+
+    with mock.patch.object(cfg, 'getpath', lambda *args, **kw: cache_dir), \
+            mock.patch.object(DebTracer, '_load_dpkg_index',
+                              load_dpkg_index):
+        tracer = DebTracer()
+        with mock.patch.object(tracer._session, "execute_command",
+                               execute_command):
+            tracer._get_dpkg_index()
+        assert not os.listdir(cache_dir)
+        loaded.pop()
+        index = get_index()
+        assert loaded == [True]
+        assert len(os.listdir(cache_dir)) == 1
+        # comes from the cache now
+        assert get_index() == index
+        assert loaded == [True]
+        # but not if dpkg state changes
+        state[0] = "/var/lib/dpkg/status 101 1473254443\n"
+        assert get_index() == index
+        assert loaded == [True, True]
+        assert len(os.listdir(cache_dir)) == 2
+
+
+def test_apt_source_interned():
+    src = APTSource(name='apt_Debian_stable_main_0', component='main',
+                    archive='stable', origin='Debian')
+    assert APTSource('apt_Debian_stable_main_0', 'main', 'stable',
+                     origin='Debian') is src
+    assert APTSource(name='apt_Debian_stable_main_0', component='main',
+                     archive='stable', origin='Debian', date=None) is src
+    other = APTSource(name='apt_Debian_stable_main_0', component='contrib',
+                      archive='stable', origin='Debian')
+    assert other is not src
+    assert {src, other, attr.evolve(other, component='main')} == {src, other}
+    with pytest.raises(attr.exceptions.FrozenInstanceError):
+        src.name = 'apt_Debian_stable_main_1'
+    assert copy.copy(src) == src
+    assert copy.deepcopy(src) == src
+
+    d = DebianDistribution(name='debian', apt_sources=[src, other, src])
+    d.normalize()
+    assert d.apt_sources == [src, other]
+
+
 @pytest.fixture
 def setup_packages():
     """set up the package comparison tests"""
@@ -203,3 +759,247 @@ def test_distribution_sub():
     result = d2-d1
     assert len(result) == 1
     assert result[0] == p1v11
+
+
+def test_distribution_packages_index():
+    (p1, p1v10, p1v11, p1ai, p1aa, p1v11ai, p2) = setup_packages()
+    d1 = DebianDistribution(name='debian 1')
+    assert not d1.satisfies_package(p1)
+    d1.packages.append(p1v11)
+    assert d1.satisfies_package(p1)
+    assert not d1.satisfies_package(p2)
+    d1.packages = [p2]
+    assert not d1.satisfies_package(p1)
+    assert d1.satisfies_package(p2)
+    # modified in place
+    d2 = DebianDistribution(name='debian 2', packages=[p1])
+    assert d1 - d2 == [p2]
+    assert not d2.satisfies(d1)
+    d2.packages[0] = p2
+    assert d1 - d2 == []
+    assert d2.satisfies(d1)
+    # index is not a part of the spec
+    assert d1 == DebianDistribution(name='debian 1', packages=[p2])
+
+
+def test_distribution_sub_large():
+    npkgs = 3000
+    d1 = DebianDistribution(
+        name='debian 1',
+        packages=[DEBPackage(name='p%d' % i, version='1.0')
+                  for i in range(npkgs)])
+    # p1 .. p3000, and only every 100th of the same version
+    d2 = DebianDistribution(
+        name='debian 2',
+        packages=[DEBPackage(name='p%d' % i,
+                             version='1.1' if i % 100 else '1.0')
+                  for i in range(npkgs, 0, -1)])
+    assert not d1.satisfies(d2)
+    assert not d2.satisfies(d1)
+    diff = d2 - d1
+    assert len(diff) == npkgs - 29
+    assert diff[0].name == 'p3000'
+    diff = d1 - d2
+    assert len(diff) == npkgs - 29
+    assert diff[0].name == 'p0'
+    assert 'p100' not in [p.name for p in diff]
+
+
+def test_distribution_verify_packages():
+    session = mock.MagicMock()
+    session.execute_command.return_value = ("""\
+ii  bash:amd64=4.4-5
+ii  dpkg:amd64=1.18.24
+rc  removed:amd64=1.0-1
+hi  held:amd64=2.0
+iU  unpacked:amd64=3.0
+ii  tzdata:all=2017c-0+deb9u1
+ii  zlib1g:amd64=1:1.2.8.dfsg-5
+ii  zlib1g:i386=1:1.2.8.dfsg-5
+""", "")
+    dist = DebianDistribution(
+        name='debian',
+        packages=[
+            DEBPackage(name='bash'),
+            DEBPackage(name='dpkg', version='1.18.23'),
+            DEBPackage(name='removed', version='1.0-1'),
+            DEBPackage(name='held', version='2.0'),
+            DEBPackage(name='unpacked'),
+            DEBPackage(name='tzdata', architecture='all'),
+            DEBPackage(name='zlib1g', architecture='i386',
+                       version='1:1.2.8.dfsg-5'),
+            DEBPackage(name='zlib1g', architecture='armhf'),
+        ])
+    with swallow_logs(new_level=logging.WARNING) as cml:
+        failed = dist.verify_packages(session)
+        assert [p.name for p in failed] == \
+            ['dpkg', 'removed', 'unpacked', 'zlib1g']
+        assert failed[3].architecture == 'armhf'
+        assert_in("Package dpkg=1.18.23 is installed as dpkg:amd64=1.18.24",
+                  cml.lines)
+        assert_in("Package removed=1.0-1 is not installed", cml.lines)
+        assert_in("Package unpacked is not installed", cml.lines)
+    # a single query for all the packages
+    assert session.execute_command.call_count == 1
+
+
+def test_distribution_install_packages():
+    session = mock.MagicMock()
+    session.execute_command.return_value = ("""\
+ii  bash:amd64=4.4-5
+ii  dpkg:amd64=1.18.24
+hi  held:amd64=2.0
+iU  unpacked:amd64=3.0
+""", "")
+    dist = DebianDistribution(
+        name='debian',
+        packages=[
+            DEBPackage(name='bash', version='4.4-5'),
+            DEBPackage(name='dpkg', version='1.18.23'),
+            DEBPackage(name='held', version='2.0'),
+            DEBPackage(name='unpacked', version='3.0'),
+            DEBPackage(name='afni', version='16.2.07~dfsg.1-2~nd90+1'),
+        ])
+    dist.install_packages(session)
+    session.execute_command.assert_called_with(
+        ['apt-get', 'install', '-y', 'dpkg=1.18.23', 'unpacked=3.0',
+         'afni=16.2.07~dfsg.1-2~nd90+1'])
+
+    session.execute_command.reset_mock()
+    dist.install_packages(session, use_version=False)
+    session.execute_command.assert_called_with(
+        ['apt-get', 'install', '-y', 'unpacked', 'afni'])
+
+    # nothing to do
+    session.execute_command.reset_mock()
+    del dist.packages[3:]
+    dist.install_packages(session, use_version=False)
+    assert session.execute_command.call_count == 1  # only dpkg-query
+
+    session.execute_command.reset_mock()
+    dist.install_packages(session, incremental=False)
+    session.execute_command.assert_called_once_with(
+        ['apt-get', 'install', '-y', 'bash=4.4-5', 'dpkg=1.18.23',
+         'held=2.0'])
+
+
+@with_tempfile(mkdir=True)
+def test_distribution_install_packages_deb_cache(cache_dir=None):
+    content = b'bash deb'
+    bash = DEBPackage(name='bash', version='1:4.4-5', architecture='amd64',
+                      sha256=hashlib.sha256(content).hexdigest())
+    dpkg = DEBPackage(name='dpkg', version='1.18.23', architecture='amd64',
+                      sha256='0' * 64)
+    dist = DebianDistribution(name='debian', packages=[bash, dpkg])
+
+    def execute_command(cmd):
+        if cmd[0] == 'find':
+            return "bash_1%3a4.4-5_amd64.deb\ndpkg_1.18.23_amd64.deb\n", ""
+        return "", ""
+
+    def get(src_path, dest_path):
+        with open(dest_path, 'wb') as f:
+            f.write(content)
+
+    session = mock.MagicMock()
+    session.execute_command.side_effect = execute_command
+    session.get.side_effect = get
+    install = ['apt-get', 'install', '-y', 'bash=1:4.4-5', 'dpkg=1.18.23']
+    with mock.patch.object(cfg, 'getpath', return_value=cache_dir):
+        dist.install_packages(session, incremental=False)
+        assert not session.put.called
+        assert session.execute_command.call_args_list == [
+            mock.call(install[:3] + ['--download-only'] + install[3:]),
+            mock.call(['find', '/var/cache/apt/archives', '-maxdepth', '1',
+                       '-name', '*.deb', '-printf', '%f\\n']),
+            mock.call(install)]
+        assert session.get.call_count == 2
+        # only the deb matching its sha256 got cached
+        cached = os.path.join(
+            cache_dir, 'bash', 'bash_1%%3a4.4-5_amd64_%s.deb' % bash.sha256)
+        assert os.listdir(os.path.join(cache_dir, 'bash')) == \
+            [os.path.basename(cached)]
+        assert not os.listdir(os.path.join(cache_dir, 'dpkg'))
+
+        session.reset_mock()
+        dist.install_packages(session, incremental=False)
+        session.put.assert_called_once_with(
+            cached, '/var/cache/apt/archives/bash_1%3a4.4-5_amd64.deb')
+        session.get.assert_called_once_with(
+            '/var/cache/apt/archives/dpkg_1.18.23_amd64.deb', mock.ANY)
+
+        # packages without checksums are not cached
+        session.reset_mock()
+        dist.packages = [DEBPackage(name='afni', version='16.2.07',
+                                    architecture='amd64')]
+        dist.install_packages(session, incremental=False)
+        session.execute_command.assert_called_once_with(
+            ['apt-get', 'install', '-y', 'afni=16.2.07'])
+        assert not session.put.called
+
+
+def test_distribution_initiate():
+    neurodebian = APTSource(
+        name='apt_NeuroDebian_xenial_main_0', component='main',
+        archive='xenial', architecture='amd64', codename='xenial',
+        origin='NeuroDebian', label='NeuroDebian', site='neuro.debian.net',
+        archive_uri='http://neuro.debian.net/debian',
+        date='2017-10-14 10:17:35+00:00')
+    dpkg_status = APTSource(name='apt__now__0', archive='now',
+                            archive_uri='/var/lib/dpkg/status')
+    policy = """\
+Package files:
+ 100 /var/lib/dpkg/status
+     release a=now
+ 500 http://neuro.debian.net/debian xenial/main amd64 Packages
+     release o=NeuroDebian,a=xenial,n=xenial,l=NeuroDebian,c=main,b=amd64
+     origin neuro.debian.net
+Pinned packages:
+"""
+    outputs = {}
+
+    def execute_command(cmd):
+        calls.append(cmd[0])
+        return outputs.get(cmd[0], ''), ''
+
+    session = mock.MagicMock()
+    session.execute_command.side_effect = execute_command
+    dist = DebianDistribution(name='debian', apt_sources=[dpkg_status])
+
+    # nothing known about the state
+    calls = []
+    dist.initiate(session)
+    assert calls == ['find', 'apt-get', 'touch']
+
+    # recently updated
+    calls = []
+    outputs['find'] = '/var/lib/apt/lists/.niceman-update-stamp\n'
+    dist.initiate(session)
+    assert calls == ['find']
+
+    # errors are not the stamp found
+    calls = []
+    outputs['find'] = "find: '/var/lib/apt/lists': Permission denied\n"
+    dist.initiate(session)
+    assert calls == ['find', 'apt-get', 'touch']
+
+    # but not if not configured to rely on it
+    calls = []
+    with mock.patch.object(cfg, 'get_as_dtype', return_value=0):
+        dist.initiate(session)
+    assert calls == ['apt-get', 'touch']
+
+    # all sources are known
+    calls = []
+    outputs['find'] = ''
+    outputs['apt-cache'] = policy
+    dist.apt_sources.append(neurodebian)
+    dist.initiate(session)
+    assert calls == ['find', 'apt-cache']
+
+    # not all sources are known
+    calls = []
+    dist.apt_sources.append(
+        attr.evolve(neurodebian, component='contrib'))
+    dist.initiate(session)
+    assert calls == ['find', 'apt-cache', 'apt-get', 'touch']
@@ -28,6 +28,8 @@ def test_distributions(demo1_spec):
     # Test DebianDistribution class.
     debian_distribution = distributions['debian']
     environment = MagicMock()
+    # nothing is installed yet
+    environment.execute_command.return_value = ('', '')
 
     with swallow_logs(new_level=logging.DEBUG) as log:
 
@@ -0,0 +1,181 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil; coding: utf-8 -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the niceman package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+import os
+from os.path import join as opj
+
+from mock import patch
+
+from niceman.cmd import Runner
+from niceman.distributions.vcs import GitRepoShim
+from niceman.distributions.vcs import SortedPaths
+from niceman.distributions.vcs import VCSTracer
+from niceman.resource.session import get_local_session
+from niceman.tests.utils import with_tempfile
+
+
+def _make_repo(path, files):
+    """Initialize a git repository at path with files committed"""
+    env = os.environ.copy()
+    env['LC_ALL'] = 'C'
+    runner = Runner(env=env, cwd=path)
+    runner('git init')
+    for f in files:
+        with open(opj(path, f), 'w') as fp:
+            fp.write(f)
+    runner(['git', 'add'] + files)
+    runner('git commit -m added')
+    return runner
+
+
+@with_tempfile(mkdir=True)
+def test_resolve_file_nested(repo=None):
+    inner = opj(repo, 'inner')
+    os.mkdir(inner)
+    _make_repo(inner, ['b'])
+    _make_repo(repo, ['a', 'c'])
+    os.mkdir(opj(inner, 'sub'))
+    with open(opj(inner, 'sub', 'untracked'), 'w'):
+        pass
+
+    tracer = VCSTracer()
+    # start from the inner one, so both are known by the end
+    assert tracer._resolve_file(opj(inner, 'b')).path == inner
+    assert tracer._resolve_file(opj(repo, 'a')).path == repo
+    assert sorted(tracer._known_repos) == [repo, inner]
+    # now resolved among the known ones, the innermost first
+    assert tracer._resolve_file(opj(inner, 'b')).path == inner
+    assert tracer._resolve_file(opj(repo, 'c')).path == repo
+    assert tracer._resolve_file(opj(repo + 'c', 'a')) is None
+    # untracked files belong to neither
+    assert tracer._resolve_file(opj(inner, 'sub', 'untracked')) is None
+    assert [r.path for r in tracer._get_known_repos_above(opj(inner, 'b'))] \
+        == [inner, repo]
+    assert tracer._get_known_repos_above(repo + 'c') == []
+
+
+
+@with_tempfile(mkdir=True)
+def test_prefetch_paths_under_repo(path=None):
+    repos = [opj(path, 'repo'), opj(path, 'repo2')]
+    for repo in repos:
+        os.mkdir(repo)
+        _make_repo(repo, ['a'])
+    files = [opj(path, 'repo2', 'a'), opj(path, 'repo', 'a'),
+             opj(path, 'other'), opj(path, 'repo.a')]
+    tracer = VCSTracer()
+    with patch.object(GitRepoShim, 'prefetch_paths') as prefetch_paths:
+        assert sorted(tracer._get_packagefields_for_files(files)) == \
+            sorted(files[:2])
+    # each repository is given only the files under it
+    assert sorted(c[0][0] for c in prefetch_paths.call_args_list) == \
+        [[opj(path, 'repo', 'a')], [opj(path, 'repo2', 'a')]]
+    assert tracer._get_files_under(path) == sorted(files)
+    assert tracer._get_files_under(opj(path, 'repo3')) == []
+
+def test_sorted_paths():
+    paths = SortedPaths("a\0b/c\0b/d\0c\0")
+    assert len(paths) == 4
+    assert list(paths) == ["a", "b/c", "b/d", "c"]
+    for p in paths:
+        assert p in paths
+    for p in ("", "0", "b", "b/", "b/e", "d"):
+        assert p not in paths
+    # unsorted ones get sorted, empty skipped
+    paths = SortedPaths("z\n\nb\na", sep="\n")
+    assert list(paths) == ["a", "b", "z"]
+    assert "z" in paths
+    assert list(SortedPaths(["b", "a"])) == ["a", "b"]
+    assert not list(SortedPaths(""))
+    # paths could be added
+    paths = SortedPaths("b\0d")
+    paths.update(["e"])
+    assert list(paths) == ["b", "d", "e"]
+    paths.update("c\0a\0")
+    assert list(paths) == ["a", "b", "c", "d", "e"]
+    assert "c" in paths and "d" in paths
+    paths = SortedPaths()
+    paths.update([])
+    assert not list(paths)
+    paths.update(["a"])
+    assert list(paths) == ["a"]
+
+
+@with_tempfile(mkdir=True)
+def test_git_prefetch_paths(repo=None):
+    os.mkdir(opj(repo, 'd'))
+    _make_repo(repo, ['a', opj('d', 'b')])
+    with open(opj(repo, 'untracked'), 'w'):
+        pass
+    shim = GitRepoShim(repo, session=get_local_session())
+    with patch.object(shim, '_session_execute_command',
+                      wraps=shim._session_execute_command) as execute:
+        shim.prefetch_paths([opj(repo, 'a'), opj(repo, 'd'),
+                             opj(repo, 'untracked'), '/elsewhere'])
+        assert shim.owns_path(opj(repo, 'a'))
+        assert not shim.owns_path(opj(repo, 'd'))
+        assert not shim.owns_path(opj(repo, 'untracked'))
+        # all answered by a single query without listing all files
+        execute.assert_called_once_with(
+            ['git', 'ls-files', '-z', '--', 'a', 'd', 'untracked'])
+        assert shim._all_files is None
+        # others are checked among all files
+        assert shim.owns_path(opj(repo, 'd', 'b'))
+        assert list(shim.all_files) == ['a', 'd/b']
+
+    # too many paths to query
+    shim = GitRepoShim(repo, session=get_local_session())
+    with patch.object(GitRepoShim, '_max_paths_to_query', 1):
+        shim.prefetch_paths([opj(repo, 'a'), opj(repo, 'd')])
+    assert not shim._owned_paths
+
+
+@with_tempfile(mkdir=True)
+def test_git_metadata(path=None):
+    repo = opj(path, 'repo')
+    os.mkdir(repo)
+    runner = _make_repo(repo, ['a'])
+    clone = opj(path, 'clone')
+    runner(['git', 'clone', '-q', repo, clone], expect_stderr=True)
+    runner = Runner(cwd=clone)
+    runner('git remote add other /nonexisting')
+    runner('git config remote.other.pushurl /nonexisting-push')
+    hexsha = runner('git rev-parse HEAD')[0].strip()
+    branch = runner('git rev-parse --abbrev-ref HEAD')[0].strip()
+
+    shim = GitRepoShim(clone, session=get_local_session())
+    with patch.object(shim._session, 'execute_command',
+                      wraps=shim._session.execute_command) as execute:
+        assert shim.hexsha == hexsha
+        assert shim.branch == branch
+        assert shim.tracked_remote == 'origin'
+        assert shim.remotes == {
+            'origin': {'url': repo, 'contains': True},
+            'other': {'url': '/nonexisting',
+                      'pushurl': '/nonexisting-push'},
+        }
+        assert shim.describe is None
+        # rev-parse, config, for-each-ref, and describe
+        assert execute.call_count == 4
+
+    # detached HEAD
+    runner('git checkout -q HEAD^0')
+    shim = GitRepoShim(clone, session=get_local_session())
+    assert shim.hexsha == hexsha
+    assert shim.branch is None
+    assert shim.tracked_remote is None
+
+    # nothing is committed yet
+    empty = opj(path, 'empty')
+    os.mkdir(empty)
+    Runner(cwd=empty)('git init')
+    shim = GitRepoShim(empty, session=get_local_session())
+    assert shim.hexsha is None
+    assert shim.branch is None
+    assert shim.remotes == []
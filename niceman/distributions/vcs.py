@@ -14,12 +14,17 @@ import abc
 import attr
 import os
 
+from array import array
+from bisect import bisect_left
+
 from collections import defaultdict
+from collections import OrderedDict
 from os.path import dirname, isdir, isabs
 from os.path import exists, lexists
 from os.path import join as opj
 
 from logging import getLogger
+from six import string_types
 from six import viewvalues
 
 from niceman.dochelpers import exc_str
@@ -120,6 +125,87 @@ class SVNDistribution(VCSDistribution):
 SVNRepo._distribution = SVNDistribution
 
 
+class SortedPaths(object):
+    """Collection of paths to check for membership
+
+    Instead of a set of strings, all the paths are kept in a single string
+    (e.g. as output by `git ls-files -z`) along with an array of offsets of
+    the paths within it.  Paths are sorted, so lookups use bisection.
+    Without a string object per path and a hash table, it takes about a
+    third of the memory of a set of the same paths.
+    """
+
+    def __init__(self, paths=(), sep='\0'):
+        """
+        Parameters
+        ----------
+        paths: str or iterable of str, optional
+          String with paths separated by sep, or an iterable of paths
+        sep: str, optional
+        """
+        self._data = ''
+        self._sep = sep
+        self._offsets = array(str('l'))
+        self.update(paths)
+
+    def update(self, paths):
+        """Add paths, given as for the constructor"""
+        sep = self._sep
+        if not isinstance(paths, string_types):
+            paths = ''.join(p + sep for p in paths)
+        if not paths:
+            return
+        prev = self[-1] if len(self) else ''
+        data = self._data
+        if data and not data.endswith(sep):
+            data += sep
+        pos = len(data)
+        data += paths
+        offsets = self._offsets
+        find = data.find
+        is_sorted = True
+        while pos < len(data):
+            end = find(sep, pos)
+            if end == -1:
+                end = len(data)
+            if end > pos:  # skip empty ones
+                offsets.append(pos)
+                if is_sorted:
+                    path = data[pos:end]
+                    is_sorted = prev <= path
+                    prev = path
+            pos = end + len(sep)
+        self._data = data
+        if not is_sorted:
+            # git lists them sorted already, others might not
+            self._sort()
+
+    def _sort(self):
+        paths = sorted(self)
+        self._data = ''.join(p + self._sep for p in paths)
+        self._offsets = offsets = array(str('l'))
+        pos = 0
+        for path in paths:
+            offsets.append(pos)
+            pos += len(path) + len(self._sep)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, i):
+        start = self._offsets[i]
+        end = self._data.find(self._sep, start)
+        return self._data[start:end if end != -1 else len(self._data)]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __contains__(self, path):
+        i = bisect_left(self, path)
+        return i < len(self) and self[i] == path
+
+
 #
 # Tracer Shims
 # We use unified VCSTracer but it needs per-VCS specific handling/
@@ -128,6 +214,7 @@ SVNRepo._distribution = SVNDistribution
 # 
 class GitSVNRepoShim(object):
     _ls_files_command = None  # just need to define in subclass
+    _ls_files_sep = '\n'
     _ls_files_filter = None
     
     _vcs_class = None  # associated VCS class
@@ -144,7 +231,8 @@ class GitSVNRepoShim(object):
         self.path = path.rstrip(os.sep)  # TODO: might be done as some rg to attr.ib
         self._session = session
         self._all_files = None
-        self._branch = None
+        # relative path -> whether owned, for paths known without all_files
+        self._owned_paths = {}
 
     def _session_execute_command(self, cmd, **kwargs):
         """Run in the session but providing our self.path as the cwd"""
@@ -158,12 +246,19 @@ class GitSVNRepoShim(object):
         if self._all_files is None:
             out, err = self._session_execute_command(self._ls_files_command)
             assert not err
-            self._all_files = set(filter(None, out.split('\n')))
+            self._all_files = SortedPaths(out, sep=self._ls_files_sep)
             if self._ls_files_filter:
                 self._all_files = self._ls_files_filter(self._all_files)
-            self._all_files = set(self._all_files)  # for efficient lookups
+                if not isinstance(self._all_files, SortedPaths):
+                    self._all_files = SortedPaths(self._all_files)
         return self._all_files
 
+    def prefetch_paths(self, paths):
+        """Given all paths under the repository which are going to be checked
+        by owns_path, possibly figure out which are owned at once
+        """
+        pass
+
     def owns_path(self, path):
         # does this repository have this directory under its control?
         if path.rstrip(os.sep) == self.path:
@@ -178,6 +273,8 @@ class GitSVNRepoShim(object):
         #  For now just a strict check, and we would want to request all files
         #  which repo knows about
         rpath = path[len(self.path)+1:]
+        if rpath in self._owned_paths:
+            return self._owned_paths[rpath]
         return rpath in self.all_files
 
     @classmethod
@@ -290,11 +387,19 @@ class SVNRepoShim(GitSVNRepoShim):
 
 class GitRepoShim(GitSVNRepoShim):
 
-    _ls_files_command = 'git ls-files'
+    _ls_files_command = ['git', 'ls-files', '-z']
+    _ls_files_sep = '\0'
+    # up to how many paths to query directly instead of listing all files
+    _max_paths_to_query = 100
 
     _vcs_class = GitRepo
     _vcs_distribution_class = GitDistribution
 
+    def __init__(self, *args, **kwargs):
+        super(GitRepoShim, self).__init__(*args, **kwargs)
+        self.__head = None
+        self.__config = None
+
     @classmethod
     def get_at_dirpath(cls, session, dirpath):
         try:
@@ -313,6 +418,32 @@ class GitRepoShim(GitSVNRepoShim):
         lgr.debug("Detected Git repository at %s for %s. Creating a session shim", topdir, dirpath)
         return cls(topdir, session=session)
 
+    def prefetch_paths(self, paths):
+        """Query at once which of the few paths are tracked by git
+
+        It avoids listing all files of a (possibly huge) repository whenever
+        only a few of its files were traced.
+        """
+        if self._all_files is not None:
+            return
+        prefix = self.path + os.sep
+        rpaths = [p[len(prefix):] for p in paths
+                  if p.startswith(prefix) and p[len(prefix):] not in
+                  self._owned_paths]
+        if not rpaths or len(rpaths) > self._max_paths_to_query:
+            return
+        try:
+            out, _ = self._session_execute_command(
+                ['git', 'ls-files', '-z', '--'] + rpaths)
+        except CommandError as exc:
+            lgr.debug("Failed to query git for paths: %s", exc_str(exc))
+            return
+        # a directory would match all the files under it, so exact matches
+        # only
+        tracked = set(out.split('\0'))
+        for rpath in rpaths:
+            self._owned_paths[rpath] = rpath in tracked
+
     def _run_git(self, cmd, expect_fail=False, **kwargs):
         """Helper to run git command, and ignore stderr"""
         cmd = ['git'] + cmd if isinstance(cmd, list) else 'git ' + cmd
@@ -329,14 +460,49 @@ class GitRepoShim(GitSVNRepoShim):
                 return None
         return out.strip()
 
+    @property
+    def _head(self):
+        """hexsha and branch (None if detached) of the HEAD"""
+        if self.__head is None:
+            try:
+                hexsha, branch = self._run_git(
+                    ['rev-parse', 'HEAD', '--abbrev-ref', 'HEAD']).split()
+            except CommandError:
+                # might still be the first yet to be committed state in the
+                # branch, so neither is defined
+                return None, None
+            self.__head = (hexsha, branch if branch != 'HEAD' else None)
+        return self.__head
+
+    @property
+    def _config(self):
+        """All git config settings, as a dict of key -> list of values"""
+        if self.__config is None:
+            try:
+                out, _ = self._session_execute_command(
+                    ['git', 'config', '-l', '-z'])
+            except CommandError as exc:
+                lgr.debug("Failed to get git config of %s: %s",
+                          self.path, exc_str(exc))
+                out = ''
+            config = OrderedDict()
+            # entries are "key\nvalue\0", and no \n if value is not set
+            for entry in out.split('\0'):
+                if entry:
+                    key, _, value = entry.partition('\n')
+                    config.setdefault(key, []).append(value)
+            self.__config = config
+        return self.__config
+
+    def _get_config(self, key):
+        """Return the (last) value of the setting in git config, or None"""
+        values = self._config.get(key)
+        return values[-1] if values else None
+
     @property
     def hexsha(self):
-        try:
-            return self._run_git('rev-parse HEAD')
-        except CommandError:
-            # might still be the first yet to be committed state in the branch
-            return None
-        
+        return self._head[0]
+
     @property
     def describe(self):
         """Let's use git describe"""
@@ -345,6 +511,22 @@ class GitRepoShim(GitSVNRepoShim):
         except CommandError:
             return None
 
+    def _get_containing_remotes(self, hexsha):
+        """Return names of the remotes which have branches containing hexsha
+        """
+        try:
+            refs = self._run_git(
+                ['for-each-ref', '--contains', hexsha,
+                 '--format=%(refname)', 'refs/remotes/'])
+            branches = [r[len('refs/remotes/'):] for r in refs.splitlines()]
+        except CommandError:
+            # older git has no --contains for for-each-ref
+            refs = self._run_git(
+                'branch -r --contains %s' % hexsha,
+                expect_fail=True)
+            branches = (refs or '').split()
+        return set(b.split('/', 1)[0] for b in branches if '/' in b)
+
     @property
     def remotes(self):
         # ideally needs to figure out the remote(s) which already have
@@ -361,27 +543,21 @@ class GitRepoShim(GitSVNRepoShim):
         # possibly valuable information
         if not hexsha:  # just initialized
             return []
-        remote_branches = self._run_git(
-            'branch -r --contains %s' % hexsha,
-            expect_fail=True)
-        if not remote_branches:
+        containing_remotes = self._get_containing_remotes(hexsha)
+        if not containing_remotes:
             return []
-        containing_remotes = set(x.split('/', 1)[0] for x in remote_branches)
         remotes = {}
-        for remote in self._run_git('remote').splitlines():
-            rec = {}
-            for f in 'url', 'pushurl':
-                try:
-                    rec[f] = self._run_git('config remote.%s.%s' % (remote, f)
-                                           , expect_fail=True
-                                           #, expect_stderr=True
-                                           )
-                except CommandError:
-                    # must have no value
-                    pass
+        # all remotes with their url and pushurl come from the config
+        for key in self._config:
+            if not key.startswith('remote.') or key.count('.') < 2:
+                continue
+            remote, field = key[len('remote.'):].rsplit('.', 1)
+            rec = remotes.setdefault(remote, {})
+            if field in ('url', 'pushurl'):
+                rec[field] = self._get_config(key)
+        for remote, rec in remotes.items():
             if remote in containing_remotes:
                 rec['contains'] = True
-            remotes[remote] = rec
         return remotes
 
     @property
@@ -389,23 +565,12 @@ class GitRepoShim(GitSVNRepoShim):
         branch = self.branch
         if not branch:
             return None
-        return self._run_git(
-                'config branch.%s.remote' % (branch,)
-                #, expect_stderr=True
-                , expect_fail=True
-        ) or None         # want explicit None
+        return self._get_config('branch.%s.remote' % (branch,)) \
+            or None         # want explicit None
 
     @property
     def branch(self):
-        if self._branch is None:
-            try:
-                branch = self._run_git('rev-parse --abbrev-ref HEAD')
-            except CommandError:
-                # could yet happen there is no commit here, so branch is not defined?
-                return None
-            if branch != 'HEAD':
-                self._branch = branch
-        return self._branch
+        return self._head[1]
 
 
 class VCSTracer(DistributionTracer):
@@ -436,7 +601,43 @@ class VCSTracer(DistributionTracer):
         # dictionary to contain per each inspected/known directory a VCS
         # instance it belongs to
         self._known_repos = {}
-        
+        # the same repositories in a trie of path components, where a
+        # repository is stored under None key of the node for its path
+        self._known_repos_trie = {}
+        # files being traced (sorted), to check ownership of at once
+        self._files = None
+
+    def _add_known_repo(self, shim):
+        self._known_repos[shim.path] = shim
+        node = self._known_repos_trie
+        for part in shim.path.split(os.sep):
+            node = node.setdefault(part, {})
+        node[None] = shim
+
+    def _get_known_repos_above(self, path):
+        """Return known repositories at or above the path, innermost first"""
+        repos = []
+        node = self._known_repos_trie
+        for part in path.rstrip(os.sep).split(os.sep):
+            node = node.get(part)
+            if node is None:
+                break
+            if None in node:
+                repos.append(node[None])
+        return repos[::-1]
+
+    def _get_files_under(self, path):
+        """Return the traced files under the path
+
+        Those are a contiguous range of the sorted files, since all of them
+        start with the path followed by the separator.
+        """
+        prefix = path.rstrip(os.sep) + os.sep
+        # the smallest string greater than all which start with the prefix
+        end = prefix[:-1] + chr(ord(os.sep) + 1)
+        return self._files[bisect_left(self._files, prefix):
+                           bisect_left(self._files, end)]
+
     def identify_distributions(self, files):
         repos, remaining_files = self.identify_packages_from_files(files)
         pkgs_per_distr = defaultdict(list)
@@ -448,6 +649,7 @@ class VCSTracer(DistributionTracer):
 
     def _get_packagefields_for_files(self, files):
         out = {}
+        self._files = sorted(files)
         for f in files:
             lgr.log(6, "%s testing file %s", self, f)
             shim = self._resolve_file(f)
@@ -490,19 +692,12 @@ class VCSTracer(DistributionTracer):
             return self._known_repos[dirpath]
 
         # it could still be a subdirectory known to the repository known above it
-        for repo in self._known_repos.values():
-            # XXX this design is nohow accounts for some fancy cases where
-            # someone could use GIT_TREE and other trickery to have out of the
-            # directory checkout.  May be some time we would get there but
-            # for now
-            # should be ok
-
-            # could be less efficient than some str manipulations but ok for now
-            if os.path.commonprefix((repo.path, path)) != repo.path:
-                continue
-
-            # could be less efficient than some str manipulations but ok for now
-            # since we rely on a strict check (must be registered within the repo)
+        # XXX this design is nohow accounts for some fancy cases where
+        # someone could use GIT_TREE and other trickery to have out of the
+        # directory checkout.  May be some time we would get there but
+        # for now should be ok
+        for repo in self._get_known_repos_above(path):
+            # we rely on a strict check (must be registered within the repo)
             if repo.owns_path(path):
                 return repo
 
@@ -514,7 +709,10 @@ class VCSTracer(DistributionTracer):
                 if lexists(dirpath) else None
             if shim:
                 # so there is one nearby -- record it
-                self._known_repos[shim.path] = shim
+                self._add_known_repo(shim)
+                shim.prefetch_paths(
+                    self._get_files_under(shim.path) if self._files
+                    else [path])
                 # but it might still not to know about the file
                 if shim.owns_path(path):
                     return shim
@@ -111,9 +111,21 @@ class Install(Interface):
             distribution.initiate(session)
             distribution.install_packages(session)
         #env_resource.execute_command_buffer()
-        # ??? verify that everything was installed according to the specs
-        #     so would need pretty much going through the spec and querying
-        #     all those packages.  If something differs -- report
+        # verify that everything was installed according to the specs
+        for distribution in environment_spec.distributions:
+            try:
+                failed = distribution.verify_packages(session)
+            except NotImplementedError:
+                lgr.debug("Verification of %s packages is not supported",
+                          distribution.name)
+                continue
+            if failed:
+                lgr.warning("%d out of %d %s packages were not installed "
+                            "as specified", len(failed),
+                            len(distribution.packages), distribution.name)
+            else:
+                lgr.info("All %d %s packages were verified to be installed",
+                         len(distribution.packages), distribution.name)
         # session.close()
         if environment_spec.files:
             lgr.warning("Got extra files listed %s", environment_spec.files)
@@ -16,6 +16,7 @@ import time
 
 from niceman.resource.session import get_local_session
 from .base import Interface
+from ..support.constraints import EnsureInt
 from ..support.constraints import EnsureNone
 from ..support.constraints import EnsureStr
 from ..support.exceptions import InsufficientArgumentsError
@@ -60,12 +61,20 @@ class Retrace(Interface):
             metavar='output_file',
             constraints=EnsureStr() | EnsureNone(),
         ),
+        jobs=Parameter(
+            args=("-J", "--jobs",),
+            doc="""number of queries (e.g. for chunks of files) to run
+            concurrently within the session.  Helps with high latency
+            (e.g. remote) sessions""",
+            metavar='N',
+            constraints=EnsureInt() | EnsureNone(),
+        ),
     )
 
     # TODO: add a session/resource so we could trace within
     # arbitrary sessions
     @staticmethod
-    def __call__(path=None, spec=None, output_file=None):
+    def __call__(path=None, spec=None, output_file=None, jobs=None):
         # heavy import -- should be delayed until actually used
 
         if not (spec or path):
@@ -92,7 +101,8 @@ class Retrace(Interface):
         # If we are to reuse their layout largely -- the rest should stay as is
         (distributions, files) = identify_distributions(
             paths,
-            session=session
+            session=session,
+            jobs=jobs
         )
         from niceman.distributions.base import EnvironmentSpec
         spec = EnvironmentSpec(
@@ -109,13 +119,16 @@ class Retrace(Interface):
 # TODO: session should be with a state.  Idea is that if we want
 #  to trace while inheriting all custom PATHs which that run might have
 #  had
-def identify_distributions(files, session=None):
+def identify_distributions(files, session=None, jobs=None):
     """Identify packages files belong to
 
     Parameters
     ----------
     files : iterable
       Files to consider
+    session : Session, optional
+    jobs : int, optional
+      Number of queries tracers could run concurrently within the session
 
     Returns
     -------
@@ -154,7 +167,7 @@ def identify_distributions(files, session=None):
             files_to_trace = [x for x in files_to_consider if x not in dirs]
             files_skipped = [x for x in files_to_consider if x in dirs]
 
-        tracer = Tracer(session=session)
+        tracer = Tracer(session=session, jobs=jobs)
         begin = time.time()
         if files_to_trace:
             for env, files_to_trace in tracer.identify_distributions(
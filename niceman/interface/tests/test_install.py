@@ -14,6 +14,7 @@ from mock import patch, call, MagicMock
 
 from ...utils import swallow_logs
 from ...tests.utils import assert_in
+from ...tests.utils import make_docker_exec_socket
 
 
 def test_install_interface(demo1_spec, niceman_cfg_path):
@@ -30,7 +31,9 @@ def test_install_interface(demo1_spec, niceman_cfg_path):
                     'Names': ['/my-resource'],
                     'State': 'running'
                 }
-            ]
+            ],
+            exec_start=lambda exec_id, socket: make_docker_exec_socket(),
+            exec_inspect=lambda exec_id: {'ExitCode': 0}
         )
 
         get_inventory.return_value = {
@@ -79,6 +82,11 @@ def test_install_interface(demo1_spec, niceman_cfg_path):
             #     container={'State': 'running', 'Id': '326b0fdfbf83', 'Names': ['/my-resource']}),
             # call().exec_create(cmd=['pip', 'install', 'piponlypkg'],
             #     container={'State': 'running', 'Id': '326b0fdfbf83', 'Names': ['/my-resource']}),
+            # verification of installed packages
+            container_call(
+                ['dpkg-query', '-W',
+                 '-f=${db:Status-Abbrev} ${Package}:${Architecture}=${Version}\\n']
+            ),
         ]
         client.assert_has_calls(calls, any_order=True)
 
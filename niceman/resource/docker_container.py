@@ -11,7 +11,13 @@
 import attr
 import docker
 import dockerpty
+import io
 import json
+import os
+import shutil
+import struct
+import tarfile
+from docker.utils.socket import read_exactly, SocketError
 from ..support.exceptions import CommandError, ResourceError
 from .base import Resource, attrib
 
@@ -147,6 +153,25 @@ class DockerContainer(Resource):
 from niceman.resource.session import POSIXSession
 
 
+def _read_multiplexed(sock):
+    """Read stdout and stderr of an exec (without a tty) from its socket
+
+    Docker sends them in frames with an 8 bytes header, where the first byte
+    identifies the stream (1 for stdout, 2 for stderr), and the last 4 are
+    the size of the frame.
+    """
+    streams = {1: [], 2: []}
+    while True:
+        try:
+            header = read_exactly(sock, 8)
+        except SocketError:
+            break  # no more frames
+        stream, size = struct.unpack('>BxxxL', header)
+        data = read_exactly(sock, size) if size else b''
+        streams.get(stream, streams[1]).append(data)
+    return b''.join(streams[1]), b''.join(streams[2])
+
+
 @attr.s
 class DockerSession(POSIXSession):
     client = attr.ib()
@@ -178,13 +203,24 @@ class DockerSession(POSIXSession):
         #    docker.errors.APIError - If the server returns an error.
         lgr.debug('Running command %r', command)
         execute = self.client.exec_create(container=self.container, cmd=command)
-        for i, line in enumerate(
-                self.client.exec_start(exec_id=execute['Id'],
-                stream=True)
-        ):
-            if line.startswith(b'rpc error'):
-                raise CommandError(cmd=command, msg="Docker error - %s" % line)
-            lgr.debug("exec#%i: %s", i, line.rstrip())
+        sock = self.client.exec_start(exec_id=execute['Id'], socket=True)
+        try:
+            out, err = _read_multiplexed(sock)
+        finally:
+            sock.close()
+        # decode at once, since a character might be split across frames
+        out = out.decode('utf-8', 'replace')
+        err = err.decode('utf-8', 'replace')
+        if out.startswith('rpc error'):
+            raise CommandError(cmd=command, msg="Docker error - %s" % out)
+        for i, line in enumerate(out.splitlines()):
+            lgr.debug("exec#%i: %s", i, line)
+        exit_code = self.client.exec_inspect(execute['Id'])['ExitCode']
+        if exit_code:
+            raise CommandError(
+                cmd=command, msg="Exited with %s" % exit_code, code=exit_code,
+                stdout=out, stderr=err)
+        return out, err
 
     # XXX should we start/stop on open/close or just assume that it is running already?
 
@@ -193,15 +229,30 @@ class DockerSession(POSIXSession):
                 owner=None, group=None, recursive=False):
         """Take file on the local file system and copy over into the session
         """
-        # self.ssh.put([src_path], remotepath=dest_path)
-        pass
+        # docker API accepts only tar archives to be extracted into a directory
+        archive = io.BytesIO()
+        tar = tarfile.open(fileobj=archive, mode='w')
+        try:
+            tar.add(src_path, arcname=os.path.basename(dest_path))
+        finally:
+            tar.close()
+        self.client.put_archive(container=self.container,
+                                path=os.path.dirname(dest_path),
+                                data=archive.getvalue())
 
     def get(self, src_path, dest_path, preserve_perms=False,
                   owner=None, group=None, recursive=False):
         """Retrieve a file from the remote system
         """
-        # self.ssh.get(src_path, localpath=dest_path)
-        pass
+        stream, _ = self.client.get_archive(container=self.container,
+                                            path=src_path)
+        tar = tarfile.open(fileobj=io.BytesIO(stream.read()))
+        try:
+            f = tar.extractfile(os.path.basename(src_path))
+            with open(dest_path, 'wb') as out:
+                shutil.copyfileobj(f, out)
+        finally:
+            tar.close()
 
 
 @attr.s
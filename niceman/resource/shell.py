@@ -16,6 +16,7 @@ import logging
 lgr = logging.getLogger('niceman.resource.shell')
 
 import os
+import shutil
 
 from .session import POSIXSession, get_updated_env
 
@@ -76,6 +77,19 @@ class ShellSession(POSIXSession):
             **run_kw
         )  # , shell=True)
 
+    def put(self, src_path, dest_path, preserve_perms=False,
+            owner=None, group=None, recursive=False):
+        """Copy file from the local file system into the session
+        (which is local as well)
+        """
+        shutil.copy(src_path, dest_path)
+
+    def get(self, src_path, dest_path, preserve_perms=False,
+            owner=None, group=None, recursive=False):
+        """Retrieve a file from the session (which is local as well)
+        """
+        shutil.copy(src_path, dest_path)
+
     def isdir(self, path):
         return os.path.isdir(path)
 
@@ -9,6 +9,7 @@
 """Resource sub-class to provide management of a SSH connection."""
 
 import attr
+import threading
 import uuid
 from pipes import quote
 
@@ -16,6 +17,7 @@ import logging
 lgr = logging.getLogger('niceman.resource.ssh')
 
 from .base import Resource, attrib
+from ..support.exceptions import CommandError
 from ..support.starcluster.sshutils import SSHClient
 
 
@@ -133,8 +135,32 @@ class SSHSession(POSIXSession):
 
         # If a command fails, a CommandError exception will be thrown.
         escaped_command = ' '.join(quote(s) for s in command)
-        for i, line in enumerate(self.ssh.execute(escaped_command)):
-            lgr.debug("exec#%i: %s", i, line.rstrip())
+        # SSHClient.execute returns stdout and stderr lines merged and
+        # stripped, so we read them ourselves from the channel
+        channel = self.ssh.transport.open_session()
+        try:
+            channel.exec_command(
+                "source /etc/profile && %s" % escaped_command)
+            # read stderr in parallel, so neither could block the command
+            err = []
+            stderr_reader = threading.Thread(
+                target=lambda: err.append(
+                    channel.makefile_stderr('rb', -1).read()))
+            stderr_reader.start()
+            out = channel.makefile('rb', -1).read()
+            stderr_reader.join()
+            exit_status = channel.recv_exit_status()
+        finally:
+            channel.close()
+        out = out.decode('utf-8', 'replace')
+        err = b''.join(err).decode('utf-8', 'replace')
+        for i, line in enumerate(out.splitlines()):
+            lgr.debug("exec#%i: %s", i, line)
+        if exit_status:
+            raise CommandError(
+                cmd=command, msg="Exited with %s" % exit_status,
+                code=exit_status, stdout=out, stderr=err)
+        return out, err
 
     def exists(self, path):
         """Return if file exists"""
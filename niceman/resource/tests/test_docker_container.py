@@ -7,12 +7,19 @@
 #
 # ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 
+import io
 import logging
+import os
+import tarfile
 from mock import patch, MagicMock, call
 
 from ...utils import swallow_logs
 from ...tests.utils import assert_in
+from ...tests.utils import with_tempfile
+from ...tests.utils import make_docker_exec_socket
+from ..docker_container import DockerSession
 from ..base import ResourceManager
+from ...support.exceptions import CommandError
 from ...support.exceptions import ResourceError
 
 from pytest import raises
@@ -47,7 +54,9 @@ def test_dockercontainer_class():
             ],
             create_container=lambda name, image, stdin_open, tty, command: {
                 'Id': '18b31b30e3a5'
-            }
+            },
+            exec_start=lambda exec_id, socket: make_docker_exec_socket(),
+            exec_inspect=lambda exec_id: {'ExitCode': 0}
         )
 
         # Test connecting when a resource doens't exist.
@@ -144,3 +153,46 @@ def test_dockercontainer_class():
 
 
 
+
+
+@with_tempfile(content="content")
+def test_dockersession_put_get(path=None):
+    client = MagicMock()
+    session = DockerSession(client=client, container={'Id': '326b0fdfbf83'})
+    session.put(path, '/tmp/copied')
+    kwargs = client.put_archive.call_args[1]
+    assert kwargs['path'] == '/tmp'
+    with tarfile.open(fileobj=io.BytesIO(kwargs['data'])) as tar:
+        assert tar.extractfile('copied').read() == b'content'
+
+    client.get_archive.return_value = (io.BytesIO(kwargs['data']), {})
+    session.get('/tmp/copied', path + '.get')
+    client.get_archive.assert_called_once_with(
+        container={'Id': '326b0fdfbf83'}, path='/tmp/copied')
+    with open(path + '.get') as f:
+        assert f.read() == "content"
+    os.unlink(path + '.get')
+
+
+def test_dockersession_execute_command():
+    client = MagicMock()
+    client.exec_create.return_value = {'Id': 'exec'}
+    client.exec_inspect.return_value = {'ExitCode': 0}
+    session = DockerSession(client=client, container={'Id': '326b0fdfbf83'})
+    # multibyte character split across frames
+    client.exec_start.side_effect = lambda exec_id, socket: \
+        make_docker_exec_socket([b'\xc3', b'\xa9\n'])
+    assert session.execute_command(['echo']) == (u'\u00e9\n', u'')
+    client.exec_start.assert_called_with(exec_id='exec', socket=True)
+
+    # undecodable output is replaced, and stderr is kept separate
+    client.exec_start.side_effect = lambda exec_id, socket: \
+        make_docker_exec_socket(b'out\xc3', b'err\n')
+    assert session.execute_command(['echo']) == (u'out\ufffd', u'err\n')
+
+    client.exec_inspect.return_value = {'ExitCode': 2}
+    with raises(CommandError) as ecm:
+        session.execute_command(['false'])
+    assert ecm.value.code == 2
+    assert ecm.value.stdout == u'out\ufffd'
+    assert ecm.value.stderr == u'err\n'
@@ -78,6 +78,17 @@ def test_isdir():
     assert ses.isdir("/bin")
 
 
+@with_tempfile(content="content")
+def test_put_get(path=None):
+    ses = ShellSession()
+    ses.put(path, path + '.put')
+    ses.get(path + '.put', path + '.get')
+    with open(path + '.get') as f:
+        assert f.read() == "content"
+    os.unlink(path + '.put')
+    os.unlink(path + '.get')
+
+
 @with_tempfile(content="""
 if ! [ "$1" = "test" ]; then
    exit 1
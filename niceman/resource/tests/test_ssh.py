@@ -8,15 +8,21 @@
 # ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 # Test string to read
 
+import io
 import logging
 import os
 import re
 import six
 import uuid
+from mock import MagicMock
 
 from ...utils import swallow_logs
 from ...tests.utils import assert_in, skip_if_no_network, skip_ssh
 from ..base import ResourceManager
+from ..ssh import SSHSession
+from ...support.exceptions import CommandError
+
+from pytest import raises
 
 
 @skip_ssh
@@ -77,3 +83,31 @@ def test_ssh_class():
         assert session.isdir('test-dir') == True
         assert session.isdir('not-a-dir') == False
         assert session.isdir('/etc/hosts') == False
+
+
+def test_sshsession_execute_command():
+    channel = MagicMock()
+    ssh = MagicMock()
+    ssh.transport.open_session.return_value = channel
+    session = SSHSession(ssh=ssh)
+
+    def run(stdout, stderr, exit_status=0):
+        channel.makefile.return_value = io.BytesIO(stdout)
+        channel.makefile_stderr.return_value = io.BytesIO(stderr)
+        channel.recv_exit_status.return_value = exit_status
+        return session.execute_command(['apt-cache', 'policy', "it's"])
+
+    # lines are kept intact, and stderr separate
+    out, err = run(b'bash:\n  Installed: 4.4-5\n     4.4-5 500\xc3\n',
+                   b'W: warning\n')
+    assert out == u'bash:\n  Installed: 4.4-5\n     4.4-5 500\ufffd\n'
+    assert err == u'W: warning\n'
+    channel.exec_command.assert_called_with(
+        "source /etc/profile && apt-cache policy 'it'\"'\"'s'")
+    assert channel.close.called
+
+    with raises(CommandError) as ecm:
+        run(b'partial\n', b'E: failed\n', exit_status=100)
+    assert ecm.value.code == 100
+    assert ecm.value.stdout == u'partial\n'
+    assert ecm.value.stderr == u'E: failed\n'
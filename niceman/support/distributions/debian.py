@@ -17,6 +17,7 @@ import re
 import string
 
 import attr
+from six import string_types
 
 lgr = logging.getLogger('niceman.distributions.debian')
 
@@ -74,6 +75,21 @@ def get_spec_from_release_file(content):
         })
 
 
+# RegExp to split source into source and version
+_RE_SOURCE = re.compile("""
+    ^(?P<source_name>[^ ]+)                # source name before any space
+    ([^(]*\((?P<source_version>[^)]+)\))?  # source version in parentheses
+""", flags=re.VERBOSE)
+
+
+def _parse_source_field(pkg):
+    """Parse Source field (if present) to get source name and version"""
+    if "Source" in pkg:
+        for match in _RE_SOURCE.finditer(pkg["Source"]):
+            pkg["Source_name"] = match.group("source_name")
+            pkg["Source_version"] = match.group("source_version")
+
+
 def parse_apt_cache_show_pkgs_output(output):
     package_info = {}
     # Split into entries (one per package)
@@ -85,11 +101,6 @@ def parse_apt_cache_show_pkgs_output(output):
         ^(?P<tag>[a-zA-Z][^:]*):[\ ]+  # Tag - begins at start of line
         (?P<val>\S.*)$           # Value - after colon to the end of the line
     """, flags=re.VERBOSE + re.MULTILINE)
-    # RegExp to split source into source and version
-    re_source = re.compile("""
-        ^(?P<source_name>[^ ]+)                # source name before any space
-        ([^(]*\((?P<source_version>[^)]+)\))?  # source version in parentheses
-    """, flags=re.VERBOSE)
 
     # For each package entry, collect single line tag/value pairs into a
     # dictionary
@@ -98,11 +109,7 @@ def parse_apt_cache_show_pkgs_output(output):
            match.group("tag"): match.group("val")
            for match in re_deb822_single_line_tag.finditer(entry)
         }
-        # Parse source line to get source version (if present)
-        if "Source" in pkg:
-            for match in re_source.finditer(pkg["Source"]):
-                pkg["Source_name"] = match.group("source_name")
-                pkg["Source_version"] = match.group("source_version")
+        _parse_source_field(pkg)
         # Name the dictionary on the Package and Version
         if "Package" in pkg and "Version" in pkg:
             if "Architecture" in pkg:
@@ -116,116 +123,260 @@ def parse_apt_cache_show_pkgs_output(output):
     return package_info
 
 
+def parse_apt_packages_index(lines, names=None):
+    """Parse records of an APT Packages index (e.g. under /var/lib/apt/lists)
+
+    Lines are consumed one at a time, so the index does not need to be
+    loaded in memory.
+
+    Parameters
+    ----------
+    lines : iterable of str
+    names : container, optional
+      Names of the packages to provide records for.  Records for all other
+      packages are skipped without being parsed
+
+    Yields
+    ------
+    dict
+      Single line fields of the record, with source name and version parsed
+      as done by `parse_apt_cache_show_pkgs_output`
+    """
+    pkg = {}
+    skip = False
+    for line in lines:
+        if not line.strip():
+            # end of the record
+            if pkg:
+                _parse_source_field(pkg)
+                yield pkg
+            pkg = {}
+            skip = False
+            continue
+        if skip or line[0] in ' \t':
+            # skipped record or continuation of a multi-line field
+            continue
+        tag, sep, val = line.partition(':')
+        val = val.strip()
+        if not sep or not val:
+            continue
+        if tag == 'Package' and names is not None and val not in names:
+            skip = True
+            continue
+        pkg[tag] = val
+    if pkg:
+        _parse_source_field(pkg)
+        yield pkg
+
+
+def _iter_lines(output):
+    """Return lines of the output, which might already be an iterable of them
+    """
+    if isinstance(output, string_types):
+        return output.splitlines()
+    return output
+
+
+# RegExp to match the header line of a package entry in apt-cache policy output
+_RE_POLICY_PKG = re.compile(
+    r"^(?P<name>[^\s:]+):((?P<architecture>\S+):)?$")
+
+
 def parse_apt_cache_policy_pkgs_output(output):
-    # findall wasn't greedy enough for some reason, so decided first to
-    # split into entries (one per package)
-    entries = filter(bool, re.split('\n(?=\S)', output, flags=re.MULTILINE))
-    # now we need to parse/match each entry
-    re_pkg = re.compile("""
-        ^(?P<name>[^\s:]+):((?P<architecture>\S+):)?\s*\n  # package name
-        \s+Installed:\s*(?P<installed>\S*)\s*\n    # Installed version
-        \s+Candidate:\s*(?P<candidate>\S*)\s*\n    # Candidate version
-        \s+Version\stable:[^\n]*
-        (?P<version_table>(\n\s.*)+)
-        """, flags=re.VERBOSE)
-
-    re_versions = re.compile("""
-        ^(\s{5}|\s(?P<installed>\*\*\*)\s)
-        (?P<version>\S+)\s+
-        (?P<priority>\S+)\n.*
-        (?P<sources>(\n\s{8}.*)+)
-    """, flags=re.VERBOSE + re.MULTILINE)
-    re_source = re.compile("""
-        ^\s{8}(?P<priority>\S+)\s+
-        (?P<source>.*)$
-    """, flags=re.VERBOSE + re.MULTILINE)
+    """Parse apt-cache policy output for packages
+
+    Parameters
+    ----------
+    output : str or iterable of str
+      Output of apt-cache policy, or lines of it (e.g. as they come from
+      the command), which are consumed in a single pass
+
+    Returns
+    -------
+    dict
+      Package name -> dict with architecture, installed and candidate
+      versions, and a list of versions each with its sources
+    """
     pkgs = {}
-    for entry in entries:
-        match = re_pkg.match(entry.strip())
-        if not match:
-            lgr.warning("FAILED in %s " % entry)
+    name = info = sources = None
+
+    def finalize():
+        if info is None:
+            return
+        if 'installed' in info and 'candidate' in info:
+            pkgs[name] = info
+        else:
+            lgr.warning("FAILED in entry for %s " % name)
+
+    for line in _iter_lines(output):
+        if line.startswith('        '):
+            # a source of the last version -- the most common line
+            if sources is not None:
+                priority, _, source = line.strip().partition(' ')
+                sources.append({'priority': priority,
+                                'source': source.lstrip()})
+            continue
+        line = line.rstrip()
+        if not line:
+            continue
+        if not line[0].isspace():
+            # a new package entry
+            finalize()
+            sources = None
+            match = _RE_POLICY_PKG.match(line)
+            if not match:
+                lgr.warning("FAILED in %s " % line)
+                name = info = None
+                continue
+            name = match.group('name')
+            info = {'architecture': match.group('architecture'),
+                    'versions': []}
+            continue
+        if info is None:
+            continue  # within an entry we failed to parse
+        fields = line.split()
+        if fields[0] in ('Installed:', 'Candidate:'):
+            info[fields[0][:-1].lower()] = fields[1] if len(fields) > 1 else ''
+        elif fields[0] == 'Version' and fields[1:] == ['table:']:
             continue
-        info = match.groupdict()
-        pkgs[info.pop('name')] = info
-        info['versions'] = []
-        for version in re_versions.finditer(info.pop('version_table')):
-            version_dict = version.groupdict()
-            version_dict["sources"] = [
-                source.groupdict()
-                for source in re_source.finditer(version.group("sources"))
-                ]
-            info['versions'].append(version_dict)
-        # process version_table
+        elif line.startswith(' *** ') or (line.startswith('     ')
+                                          and not line[5].isspace()):
+            # a version within version table, e.g. " *** 1.0-1 500"
+            installed = fields.pop(0) if fields[0] == '***' else None
+            sources = []
+            info['versions'].append({
+                'installed': installed,
+                'version': fields[0],
+                'priority': fields[1] if len(fields) > 1 else None,
+                'sources': sources
+            })
+        else:
+            lgr.debug("Skipping unknown line in entry for %s: %r",
+                      name, line)
+            # so its sources (if any) do not get assigned to a version
+            sources = None
+    finalize()
     return pkgs
-    #for pkg_match in re_pkg.finditer(output):
-    #    print type(pkg_match), pkg_match.groupdict()
+
+
+# Release line in apt-cache policy has terse tag=value format.  A value
+# follows the "=", and include any non commas, or commas not followed by
+# another tag
+_RE_POLICY_REL_ATTRIB = re.compile("""
+    (?P<tag>[a-z])=    # A tag is a single letter followed by "="
+    (?P<value>([^,]|(,(?![a-z]=)))*)
+    """, flags=re.VERBOSE)
+_RE_POLICY_SOURCE_LINE = re.compile("""
+    (?P<archive_uri>\S+)        # Archive URI up to the first " "
+    (\ (?P<uri_suite>[^/]+))?   # The suite goes up to the first "/"
+    """, flags=re.VERBOSE)
+# This maps the release tags to more meaningful values
+_POLICY_REL_TAG_MAP = {
+    "c": "component",
+    "n": "codename",
+    "a": "archive",
+    "b": "architecture",
+    "o": "origin",
+    "l": "label"
+}
 
 
 def parse_apt_cache_policy_source_info(policy_output):
+    """Parse information about sources from apt-cache policy output
+
+    Parameters
+    ----------
+    policy_output : str or iterable of str
+      Output of apt-cache policy (without arguments), or lines of it, which
+      are consumed in a single pass
+
+    Returns
+    -------
+    dict
+      Source line -> dict with its archive_uri, uri_suite, site, and
+      details from the release line
+    """
     source_info = {}
-    re_section = re.compile("""
-        ^(?P<header_line>\S.*)$[\r\n]*  # Header - non whitespace at the
-                                        #          beginning of the line
-        (?P<body>(^\ .*$[\r\n]*)*)      # Body - All subsequent lines that
-                                        #        begin with a space
-        """, flags=re.VERBOSE + re.MULTILINE)
-    re_source = re.compile("""
-        ^(\ (?P<priority>[0-9]+)\ +(?P<source>.*)$[\r\n]+
-         (^(
-            (\ \ +release\ +(?P<release_info>.*))|
-            (\ \ +origin\ +(?P<origin_info>.*))|
-            (\ \ .*)
-           )$[\r\n]+
-          )*
-        )
-        """, flags=re.VERBOSE + re.MULTILINE)
-    re_rel_attrib = re.compile("""
-        (?P<tag>[a-z])=    # A tag is a single letter followed by "="
-        (?P<value>([^,]|(,(?![a-z]=)))*)
-                           # The value follows the "=", and include any
-                           # non commas, or commas not followed by another tag
-        """, flags=re.VERBOSE)
-    re_source_line = re.compile("""
-        (?P<archive_uri>\S+)        # Archive URI up to the first " "
-        (\ (?P<uri_suite>[^/]+))?   # The suite goes up to the first "/"
-        """, flags=re.VERBOSE)
-    # The release line has a terse tag=value format. This maps
-    # the release tags to more meaningful values
-    tag_map = {"c": "component",
-               "n": "codename",
-               "a": "archive",
-               "b": "architecture",
-               "o": "origin",
-               "l": "label"}
-
-    sections = re_section.finditer(policy_output)
-    for section in sections:
-        if section.group("header_line").startswith("Package files:"):
-            sources = re_source.finditer(section.group("body"))
-            for source in sources:
-                info = source.groupdict()
-                if info.get("source"):
-                    src_detail = dict()
-                    src_detail["site"] = info.get("origin_info")
-                    match = re_source_line.search(info.get("source"))
-                    if match:
-                        match = match.groupdict()
-                        src_detail["archive_uri"] = match["archive_uri"]
-                        src_detail["uri_suite"] = match["uri_suite"]
-                    else:
-                        lgr.warning("Unexpected source line %s" %
-                                    info.get("source"))
-                    release_info = info.get("release_info")
-                    if release_info:
-                        attribs = re_rel_attrib.finditer(release_info)
-                        for attrib in attribs:
-                            if attrib.group("tag") in tag_map:
-                                src_detail[tag_map[attrib.group("tag")]] = \
-                                    attrib.group("value")
-                    source_info[info.get("source")] = src_detail
+    in_package_files = False
+    src_detail = None
+    for line in _iter_lines(policy_output):
+        line = line.rstrip()
+        if not line:
+            continue
+        if not line[0].isspace():
+            # Header of a section
+            in_package_files = line.startswith("Package files:")
+            src_detail = None
+            continue
+        if not in_package_files:
+            continue
+        if line[1:2].isdigit():
+            # A source line, e.g. " 500 http://... stretch/main amd64 Packages"
+            priority, _, source = line[1:].partition(' ')
+            source = source.lstrip()
+            if not (priority.isdigit() and source):
+                src_detail = None
+                continue
+            src_detail = source_info[source] = {"site": None}
+            match = _RE_POLICY_SOURCE_LINE.match(source)
+            if match:
+                src_detail["archive_uri"] = match.group("archive_uri")
+                src_detail["uri_suite"] = match.group("uri_suite")
+            else:
+                lgr.warning("Unexpected source line %s" % source)
+            continue
+        if src_detail is None or not line.startswith('  '):
+            continue
+        tag, _, value = line.strip().partition(' ')
+        value = value.lstrip()
+        if tag == 'origin':
+            src_detail["site"] = value
+        elif tag == 'release':
+            for attrib in _RE_POLICY_REL_ATTRIB.finditer(value):
+                if attrib.group("tag") in _POLICY_REL_TAG_MAP:
+                    src_detail[_POLICY_REL_TAG_MAP[attrib.group("tag")]] = \
+                        attrib.group("value")
     return source_info
 
 
+def parse_dpkg_list_files_output(output):
+    """Parse concatenated content of dpkg's info/*.list files
+
+    Content of each file is expected to be preceded by a header line which
+    contains a tab followed by the path to the .list file.
+
+    Yields
+    ------
+    (name, architecture, path)
+      where architecture is None unless the .list file name carries it (as
+      it is done for Multi-Arch: same packages)
+    """
+    name = architecture = None
+    for line in output.splitlines():
+        if line.startswith('\t'):
+            # e.g. /var/lib/dpkg/info/zlib1g:amd64.list
+            stem = line[1:].rsplit('/', 1)[-1][:-len('.list')]
+            name, _, architecture = stem.partition(':')
+            architecture = architecture or None
+        elif line and line != '/.' and name:
+            yield name, architecture, line
+
+
+def parse_dpkg_diversions(content):
+    """Parse content of /var/lib/dpkg/diversions
+
+    Yields
+    ------
+    tuple
+      (from, to, package) for each diversion, where package is None for a
+      local diversion (by the administrator)
+    """
+    lines = content.splitlines()
+    for i in range(0, len(lines) - len(lines) % 3, 3):
+        from_, to, package = lines[i:i + 3]
+        yield from_, to, None if package == ':' else package
+
+
 def get_apt_release_file_names(url, url_suite):
     url = url.strip("/")              # Remove any trailing /
     url = url.replace("http://", "")  # Remove leading http://
@@ -235,5 +386,6 @@ def get_apt_release_file_names(url, url_suite):
         filename = url + "_dists_" + url_suite
     else:
         filename = url
-    return ["/var/lib/apt/lists/" + filename + "_Release",
-            "/var/lib/apt/lists/" + filename + "_InRelease"]
+    # InRelease is tried first since it is what modern APT fetches
+    return ["/var/lib/apt/lists/" + filename + "_InRelease",
+            "/var/lib/apt/lists/" + filename + "_Release"]
@@ -253,6 +253,67 @@ skype:i386:
                            'version': '1.0.2g-1ubuntu4'}]}}
     out = parse_apt_cache_policy_pkgs_output(txt1)
     assert_is_subset_recur(out1, out, [dict])
+    assert sorted(out) == ['afni', 'alienblaster', 'openssl',
+                           'python-biotools', 'python-nibabel', 'skype']
+    assert out['skype']['architecture'] == 'i386'
+    assert len(out['python-nibabel']['versions'][0]['sources']) == 5
+    # lines could be consumed as they come
+    assert parse_apt_cache_policy_pkgs_output(
+        iter(txt1.splitlines(True))) == out
+
+
+def test_parse_apt_cache_policy_pkgs_output_pin():
+    from ..debian import parse_apt_cache_policy_pkgs_output
+    out = parse_apt_cache_policy_pkgs_output("""\
+afni:
+  Installed: 16.2.07~dfsg.1-2~nd90+1
+  Candidate: 16.2.07~dfsg.1-2~nd90+1
+  Package pin: 16.2.07~dfsg.1-2~nd90+1
+  Version table:
+ *** 16.2.07~dfsg.1-2~nd90+1 1001
+        500 http://neuro.debian.net/debian stretch/contrib amd64 Packages
+""")
+    assert out['afni']['versions'] == [{
+        'installed': '***',
+        'version': '16.2.07~dfsg.1-2~nd90+1',
+        'priority': '1001',
+        'sources': [{'priority': '500',
+                     'source': 'http://neuro.debian.net/debian '
+                               'stretch/contrib amd64 Packages'}]
+    }]
+
+
+def test_parse_apt_cache_policy_pkgs_output_large():
+    from ..debian import parse_apt_cache_policy_pkgs_output
+    npkgs = 2000
+
+    def gen_lines():
+        for i in range(npkgs):
+            yield "pkg%d:" % i
+            yield "  Installed: (none)"
+            yield "  Candidate: 1.%d" % i
+            yield "  Version table:"
+            yield "     1.%d 500" % i
+            for arch in ('amd64', 'i386'):
+                yield "        500 http://deb.debian.org/debian " \
+                      "sid/main %s Packages" % arch
+
+    out = parse_apt_cache_policy_pkgs_output(gen_lines())
+    assert len(out) == npkgs
+    assert out['pkg1999'] == {
+        'architecture': None,
+        'installed': '(none)',
+        'candidate': '1.1999',
+        'versions': [{'installed': None,
+                      'version': '1.1999',
+                      'priority': '500',
+                      'sources': [
+                          {'priority': '500',
+                           'source': 'http://deb.debian.org/debian '
+                                     'sid/main amd64 Packages'},
+                          {'priority': '500',
+                           'source': 'http://deb.debian.org/debian '
+                                     'sid/main i386 Packages'}]}]}
 
 def test_parse_apt_cache_policy_source_info():
     from ..debian import parse_apt_cache_policy_source_info
@@ -336,6 +397,16 @@ Pinned packages:
             }
     out = parse_apt_cache_policy_source_info(txt)
     assert_is_subset_recur(out1, out, [dict])
+    assert len(out) == 14
+    assert out['/var/lib/dpkg/status'] == {'archive': 'now',
+                                           'archive_uri': '/var/lib/dpkg/status',
+                                           'site': None,
+                                           'uri_suite': None}
+    assert out['file:/my/repo ./ Packages']['uri_suite'] == '.'
+    assert out['http://dl.google.com/linux/chrome/deb stable/main amd64 '
+               'Packages']['origin'] == 'Google, Inc.'
+    assert parse_apt_cache_policy_source_info(
+        iter(txt.splitlines(True))) == out
 
 
 def test_get_apt_release_file_names():
@@ -348,3 +419,70 @@ def test_get_apt_release_file_names():
     assert "/var/lib/apt/lists/_my_repo2_ubuntu_InRelease" in fn
     assert "/var/lib/apt/lists/_my_repo2_ubuntu_Release" in fn
 
+
+
+def test_parse_dpkg_list_files_output():
+    from ..debian import parse_dpkg_list_files_output
+    out = """\
+\t/var/lib/dpkg/info/dash.list
+/.
+/bin
+/bin/sh
+\t/var/lib/dpkg/info/zlib1g:i386.list
+/lib/i386-linux-gnu/libz.so.1.2.8
+"""
+    assert list(parse_dpkg_list_files_output(out)) == [
+        ('dash', None, '/bin'),
+        ('dash', None, '/bin/sh'),
+        ('zlib1g', 'i386', '/lib/i386-linux-gnu/libz.so.1.2.8'),
+    ]
+
+
+def test_parse_apt_packages_index():
+    from ..debian import parse_apt_packages_index
+    lines = """\
+Package: alienblaster
+Architecture: amd64
+Version: 1.1.0-9
+Source: alienblaster-src (1.1.0)
+Description: Classic 2D shoot 'em up
+ Your mission is simple: Stop the invasion of the aliens and blast them!
+Size: 180278
+
+Package: openssl
+Architecture: amd64
+Version: 1.0.2g-1ubuntu4
+""".splitlines()
+    assert list(parse_apt_packages_index(lines)) == [
+        {'Package': 'alienblaster',
+         'Architecture': 'amd64',
+         'Version': '1.1.0-9',
+         'Source': 'alienblaster-src (1.1.0)',
+         'Source_name': 'alienblaster-src',
+         'Source_version': '1.1.0',
+         'Description': "Classic 2D shoot 'em up",
+         'Size': '180278'},
+        {'Package': 'openssl',
+         'Architecture': 'amd64',
+         'Version': '1.0.2g-1ubuntu4'}
+    ]
+    assert [p['Package']
+            for p in parse_apt_packages_index(lines, {'openssl'})] == \
+        ['openssl']
+
+
+def test_parse_dpkg_diversions():
+    from ..debian import parse_dpkg_diversions
+    content = """\
+/bin/sh
+/bin/sh.distrib
+dash
+/usr/bin/vi
+/usr/bin/vi.orig
+:
+/incomplete
+"""
+    assert list(parse_dpkg_diversions(content)) == [
+        ('/bin/sh', '/bin/sh.distrib', 'dash'),
+        ('/usr/bin/vi', '/usr/bin/vi.orig', None),
+    ]
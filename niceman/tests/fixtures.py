@@ -9,6 +9,7 @@
 
 import pytest
 from .constants import NICEMAN_CFG_PATH
+from .. import cfg
 
 # Substitutes in for user's ~/.config/niceman.cfg file
 CONFIGURATION = [
@@ -18,3 +19,12 @@ CONFIGURATION = [
 @pytest.fixture(params=CONFIGURATION)
 def niceman_cfg_path(request):
     yield request.param
+
+
+@pytest.fixture(autouse=True)
+def niceman_user_cache_dir(tmpdir, monkeypatch):
+    """Keep caches produced by the tests out of the user's cache directory"""
+    path = str(tmpdir.join('cache'))
+    monkeypatch.setattr(type(cfg.dirs), 'user_cache_dir',
+                        property(lambda self: path))
+    yield path
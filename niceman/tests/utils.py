@@ -169,6 +169,23 @@ def ok_generator(gen):
     assert_true(inspect.isgenerator(gen), msg="%s is not a generator" % gen)
 
 
+def make_docker_exec_socket(stdout=b'', stderr=b''):
+    """Return a socket providing output of a docker exec, as it would be sent
+
+    Frames are prefixed with the header identifying the stream and their size.
+    stdout and stderr could be lists of chunks to be sent in separate frames.
+    """
+    import struct
+    sock, peer = socket.socketpair()
+    for stream, chunks in ((1, stdout), (2, stderr)):
+        if isinstance(chunks, binary_type):
+            chunks = [chunks] if chunks else []
+        for data in chunks:
+            peer.sendall(struct.pack('>BxxxL', stream, len(data)) + data)
+    peer.close()
+    return sock
+
+
 def ok_file_has_content(path, content):
     """Verify that file exists and has expected content"""
     assert(exists(path))
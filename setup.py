@@ -44,7 +44,7 @@ niceman_pkgs = [pkg for pkg in find_packages('.') if pkg.startswith('niceman')]
 requires = {
     'core': [
         'appdirs',
-        'attrs>=16.3.0',
+        'attrs>=17.1.0',  # for attr.evolve
         'humanize',
         'mock',  # mock is also used for auto.py, not only for testing
         'pyyaml',
@@ -66,7 +66,7 @@ requires = {
         'chardet',  # python-debian misses dependency on it
     ],
     'docker': [
-        'docker-py>=0.3.2',
+        'docker-py>=1.10.0',  # for docker.utils.socket.read_exactly
         'dockerpty',
     ],
     'aws': [